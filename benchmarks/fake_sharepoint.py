@@ -0,0 +1,248 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import Counter
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+
+# Minimal stand-in for the SharePoint REST endpoints used by sharepoint.py.
+#
+# The server can also behave like a loaded farm (see start_fake_sharepoint):
+#   latency / jitter  - seconds added to every response, plus up to jitter more
+#   error_rate        - share of requests answered with a 500
+#   throttle_rate     - share of requests answered with a 429 and Retry-After
+#   max_concurrent    - requests served at once before the rest get a 503
+#   batch_supported   - False answers $batch with a 404, like SharePoint 2013
+class FakeSharePointHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer headers and body into one write to avoid delayed-ACK stalls on keep-alive
+    wbufsize = 64 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json;odata=verbose')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def record(self, operation):
+        self.server.calls[operation] += 1
+
+    # Keep the fields a MERGE, $batch PATCH or ValidateUpdateListItem set on an item
+    def store_fields(self, item_id, fields):
+        with self.server.lock:
+            self.server.fields.setdefault(item_id, {}).update(
+                (name, value) for name, value in fields.items() if name != '__metadata')
+
+    # One page of a library's items in ID order, like GetByTitle(...)/items with $top and
+    # a Paged=TRUE&p_ID=n $skiptoken, or the last item with $orderby=ID desc
+    def send_list_items(self, library_name, split):
+        query = {name: values[0] for name, values in parse_qs(split.query).items()}
+        top = int(query.get('$top', 100))
+        with self.server.lock:
+            items = sorted((item_id, file_url) for file_url, item_id in self.server.items.items()
+                           if f"/{library_name}/" in file_url)
+        if query.get('$orderby') == 'ID desc':
+            items.reverse()
+        else:
+            skiptoken = re.search(r"p_ID=(\d+)", query.get('$skiptoken', ''))
+            after = int(skiptoken.group(1)) if skiptoken else 0
+            items = [item for item in items if item[0] > after]
+        last = re.fullmatch(r"ID le (\d+)", query.get('$filter', ''))
+        if last:
+            items = [item for item in items if item[0] <= int(last.group(1))]
+        page = items[:top]
+        results = []
+        for item_id, file_url in page:
+            results.append(dict(self.server.fields.get(item_id, {}), ID=item_id, FileRef=file_url,
+                                FileLeafRef=file_url.rsplit('/', 1)[-1], FSObjType=0,
+                                File={"Length": str(self.server.lengths.get(file_url, 0))}))
+        payload = {"results": results}
+        if len(items) > top and query.get('$orderby') != 'ID desc':
+            next_query = dict(query, **{'$skiptoken': f"Paged=TRUE&p_ID={page[-1][0]}"})
+            payload["__next"] = f"http://{self.headers['Host']}{split.path}?{urlencode(next_query)}"
+        return self.send_json(200, {"d": payload})
+
+    # Apply the configured latency and faults; returns True when the request was answered with one
+    def inject_faults(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            overloaded = server.max_concurrent is not None and server.active > server.max_concurrent
+        try:
+            if server.latency or server.jitter:
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+            if overloaded:
+                server.faults['overloaded'] += 1
+                self.send_json(503, {"error": {"message": {"value": "Server Too Busy"}}}, {'Retry-After': '1'})
+                return True
+            if random.random() < server.throttle_rate:
+                server.faults['throttled'] += 1
+                self.send_json(429, {"error": {"message": {"value": "Too Many Requests"}}},
+                               {'Retry-After': str(server.retry_after)})
+                return True
+            if random.random() < server.error_rate:
+                server.faults['errors'] += 1
+                self.send_json(500, {"error": {"message": {"value": "Internal Server Error"}}})
+                return True
+            return False
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def do_GET(self):
+        if self.inject_faults():
+            return
+        path = unquote(urlsplit(self.path).path)
+        if path.endswith('/ListItemAllFields'):
+            self.record('ListItemAllFields')
+            file_url = re.search(r"GetFileByServerRelativeUrl\('(.*)'\)", path).group(1)
+            item_id = self.server.items.get(file_url)
+            if item_id is None:
+                return self.send_json(404, {"error": {"message": {"value": "File Not Found."}}})
+            return self.send_json(200, {"d": {"ID": item_id}})
+        match = re.search(r"GetFileByServerRelativeUrl\('(.*)'\)$", path)
+        if match:
+            self.record('GetFile')
+            file_url = match.group(1)
+            if file_url not in self.server.items:
+                return self.send_json(404, {"error": {"message": {"value": "File Not Found."}}})
+            return self.send_json(200, {"d": {"Length": str(self.server.lengths.get(file_url, 0)),
+                                              "ListItemAllFields": {"ID": self.server.items[file_url]}}})
+        match = re.search(r"GetByTitle\('(.*)'\)/items$", path)
+        if match:
+            self.record('items')
+            return self.send_list_items(match.group(1), urlsplit(self.path))
+        if 'GetByTitle(' in path:
+            self.record('GetByTitle')
+            return self.send_json(200, {"d": {"ListItemEntityTypeFullName": "SP.Data.DocumentsItem"}})
+        if 'GetFolderByServerRelativeUrl(' in path:
+            self.record('GetFolder')
+            return self.send_json(200, {"d": {"Exists": True}})
+        self.send_json(404)
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.inject_faults():
+            return
+        split = urlsplit(self.path)
+        path = unquote(split.path)
+        if path.endswith('/_api/contextinfo'):
+            self.record('contextinfo')
+            return self.send_json(200, {"d": {"GetContextWebInformation": {
+                "FormDigestValue": "0x0FAKE", "FormDigestTimeoutSeconds": 1800}}})
+        match = re.search(r"GetFolderByServerRelativeUrl\('(.*)'\)/Files/add\(url='(.*)',overwrite=(true|false)\)", path)
+        if match:
+            self.record('Files/add')
+            self.server.bytes_received += len(body)
+            file_url = f"{match.group(1)}/{match.group(2)}"
+            if match.group(3) == 'false' and file_url in self.server.items:
+                return self.send_json(400, {"error": {"message": {
+                    "value": f"A file with the name {file_url} already exists."}}})
+            item_id = self.server.items.setdefault(file_url, next(self.server.item_ids))
+            self.server.lengths[file_url] = len(body)
+            payload = {"ServerRelativeUrl": file_url, "Length": len(body)}
+            if 'ListItemAllFields' in unquote(split.query):
+                payload["ListItemAllFields"] = {"ID": item_id}
+            return self.send_json(200, {"d": payload})
+        match = re.search(r"GetFileByServerRelativeUrl\('(.*)'\)/(StartUpload|ContinueUpload|FinishUpload|CancelUpload)"
+                          r"\(uploadId=guid'([^']+)'(?:,fileOffset=(\d+))?\)", path)
+        if match:
+            file_url, operation, upload_id, file_offset = match.groups()
+            self.record(operation)
+            uploads = self.server.uploads
+            if operation == 'CancelUpload':
+                uploads.pop(upload_id, None)
+                return self.send_json(200, {"d": {"CancelUpload": None}})
+            if operation == 'StartUpload':
+                uploads[upload_id] = 0
+            elif upload_id not in uploads or int(file_offset) != uploads[upload_id]:
+                return self.send_json(400, {"error": {"message": {"value": "Invalid upload offset."}}})
+            uploads[upload_id] += len(body)
+            self.server.bytes_received += len(body)
+            if operation != 'FinishUpload':
+                return self.send_json(200, {"d": {operation: str(uploads[upload_id])}})
+            self.server.lengths[file_url] = uploads[upload_id]
+            payload = {"ServerRelativeUrl": file_url, "Length": uploads.pop(upload_id)}
+            if 'ListItemAllFields' in unquote(split.query):
+                payload["ListItemAllFields"] = {"ID": self.server.items[file_url]}
+            return self.send_json(200, {"d": payload})
+        if path.endswith('/ValidateUpdateListItem'):
+            self.record('ValidateUpdateListItem')
+            form_values = json.loads(body)['formValues']
+            file_url = re.search(r"GetFileByServerRelativeUrl\('(.*)'\)/", path).group(1)
+            if file_url in self.server.items:
+                self.store_fields(self.server.items[file_url],
+                                  {field['FieldName']: field['FieldValue'] for field in form_values})
+            results = [{"FieldName": field['FieldName'], "HasException": False, "ErrorMessage": None}
+                       for field in form_values]
+            return self.send_json(200, {"d": {"ValidateUpdateListItem": {"results": results}}})
+        if path.endswith('/_api/$batch'):
+            self.record('$batch')
+            if not self.server.batch_supported:
+                return self.send_json(404, {"error": {"message": {"value": "Resource not found."}}})
+            # Answer every PATCH of an item, in order, like SharePoint's multipart response
+            merges = re.findall(r"^PATCH \S+/items\((\d+)\) HTTP/1\.1\r\n.*?\r\n\r\n(.*?)\r\n--",
+                                body.decode('utf-8'), re.M | re.S)
+            for item_id, fields in merges:
+                self.store_fields(int(item_id), json.loads(fields))
+            self.server.calls['batched MERGE'] += len(merges)
+            boundary = f"batchresponse_{next(self.server.item_ids)}"
+            payload = "".join(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n"
+                f"HTTP/1.1 204 No Content\r\nCONTENT-TYPE: application/json;odata=verbose;charset=utf-8\r\n\r\n\r\n"
+                for _ in merges
+            ) + f"--{boundary}--\r\n"
+            data = payload.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', f"multipart/mixed; boundary={boundary}")
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            return self.wfile.write(data)
+        match = re.search(r"/items\((\d+)\)$", path)
+        if match and self.headers.get('X-HTTP-Method') == 'MERGE':
+            self.record('MERGE')
+            self.store_fields(int(match.group(1)), json.loads(body))
+            return self.send_json(204)
+        self.send_json(404)
+
+
+def start_fake_sharepoint(host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                          retry_after=1, max_concurrent=None, batch_supported=True):
+    server = ThreadingHTTPServer((host, port), FakeSharePointHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.throttle_rate = throttle_rate
+    server.retry_after = retry_after
+    server.max_concurrent = max_concurrent
+    server.batch_supported = batch_supported
+    server.active = 0
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.faults = Counter()
+    server.calls = Counter()
+    server.items = {}
+    server.lengths = {}
+    server.fields = {}
+    server.item_ids = itertools.count(1)
+    server.uploads = {}
+    server.bytes_received = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta, timezone
+from PIL import Image
+from sqlalchemy import create_engine, event, text
+import io
+import os
+import random
+
+# SQLite stand-in for DB_TABLE_1, filled with synthetic documents, so database.py can
+# run without SQL Server. use_fake_source() points database.get_engine at it, adds the
+# T-SQL functions database.py calls, and swaps the claim query (a CTE UPDATE ... OUTPUT
+# with table hints) for its SQLite equivalent, UPDATE ... RETURNING.
+
+COLUMNS = (
+    "FILEID INTEGER, RSAPIN TEXT, FNAME TEXT, LNAME TEXT, MNAME TEXT, PHONE TEXT, EMPNAME TEXT, "
+    "EMPCODE TEXT, DOCTYPE_NAME TEXT, EDESC TEXT, FILEITEM BLOB, FILENAME TEXT, APPLICATION_TYPE TEXT, "
+    "status TEXT, doc_link TEXT, FILE_PATH TEXT, CLAIMED_BY TEXT, LEASE_EXPIRES TEXT, ATTEMPTS INTEGER"
+)
+
+
+def _utc_now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def _date_add(unit, amount, value):
+    moment = datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return (moment + timedelta(**{f"{unit}s": amount})).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def create_fake_source(path, table):
+    engine = create_engine(f"sqlite:///{path}", connect_args={'check_same_thread': False, 'timeout': 60})
+
+    @event.listens_for(engine, 'connect')
+    def register_functions(connection, record):
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.create_function('SYSUTCDATETIME', 0, _utc_now)
+        connection.create_function('DATEADD', 3, _date_add)
+        connection.create_function('DATALENGTH', 1, lambda value: len(value) if value is not None else None)
+
+    # DATEADD's first argument is a bare keyword in T-SQL
+    @event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def translate(connection, cursor, statement, parameters, context, executemany):
+        return statement.replace('DATEADD(second, ', "DATEADD('second', "), parameters
+
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        connection.execute(text(f"CREATE TABLE {table} ({COLUMNS})"))
+        connection.execute(text(f"CREATE INDEX {table}_pending ON {table} (APPLICATION_TYPE, status, FILEID, FILENAME)"))
+    return engine
+
+
+# Synthetic documents: PDFs padded with random bytes and noise PNGs of about size bytes.
+# duplicate_ratio of them repeat the content and RSAPin of an earlier document.
+def synthetic_documents(count, size, png_ratio=0.2, duplicate_ratio=0.0, seed=1):
+    generator = random.Random(seed)
+    earlier = []
+    for index in range(count):
+        pin = f"PEN{100000000000 + index}"
+        if earlier and generator.random() < duplicate_ratio:
+            extension, content, pin = generator.choice(earlier)
+        elif generator.random() < png_ratio:
+            side = max(int((size / 3) ** 0.5), 1)
+            buffer = io.BytesIO()
+            Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(buffer, 'PNG', compress_level=0)
+            extension, content = '.png', buffer.getvalue()
+        else:
+            extension, content = '.pdf', b'%PDF-1.4\n' + os.urandom(max(size - 16, 0)) + b'\n%%EOF\n'
+        if len(earlier) < 100:
+            earlier.append((extension, content, pin))
+        yield {
+            'FILEID': index, 'RSAPIN': pin, 'FNAME': 'Ada', 'LNAME': 'Lovelace',
+            'MNAME': 'B', 'PHONE': '0800000000', 'EMPNAME': 'Bench Ltd', 'EMPCODE': 'B001',
+            'DOCTYPE_NAME': 'Bench Document', 'EDESC': '', 'FILENAME': f"doc_{index}{extension}",
+            'FILEITEM': content
+        }
+
+
+# Insert documents as pending rows; with file_dir, their content is written there as
+# files and referenced through FILE_PATH instead of stored in FILEITEM
+def add_documents(engine, table, documents, application_type='DMU', file_dir=None):
+    with engine.begin() as connection:
+        for document in documents:
+            row = dict(document, APPLICATION_TYPE=application_type, FILE_PATH=None)
+            if file_dir is not None:
+                row['FILE_PATH'] = os.path.join(file_dir, row['FILENAME'])
+                with open(row['FILE_PATH'], 'wb') as file:
+                    file.write(row['FILEITEM'])
+                row['FILEITEM'] = None
+            connection.execute(text(
+                f"INSERT INTO {table} (FILEID, RSAPIN, FNAME, LNAME, MNAME, PHONE, EMPNAME, EMPCODE, "
+                f"DOCTYPE_NAME, EDESC, FILEITEM, FILENAME, APPLICATION_TYPE, FILE_PATH) VALUES "
+                f"(:FILEID, :RSAPIN, :FNAME, :LNAME, :MNAME, :PHONE, :EMPNAME, :EMPCODE, "
+                f":DOCTYPE_NAME, :EDESC, :FILEITEM, :FILENAME, :APPLICATION_TYPE, :FILE_PATH)"
+            ), row)
+
+
+def use_fake_source(engine):
+    import database
+    from settings import get_settings
+
+    def claim_documents(selectors, worker_id, batch_size, content_column):
+        selector_filter, params = database.build_selector_filter(selectors)
+        query_table = get_settings().db_table
+        query = text(
+            f"UPDATE {query_table} SET [CLAIMED_BY] = :worker_id, "
+            f"[LEASE_EXPIRES] = DATEADD(second, :lease_seconds, SYSUTCDATETIME()) "
+            f"WHERE rowid IN (SELECT rowid FROM {query_table} WHERE [status] IS NULL "
+            f"AND {selector_filter} "
+            f"AND ([CLAIMED_BY] IS NULL OR [LEASE_EXPIRES] < SYSUTCDATETIME()) "
+            f"ORDER BY [FILEID], [FILENAME] LIMIT {int(batch_size)}) "
+            f"RETURNING [FILEID] AS fileid, [RSAPIN] AS pin, [FNAME] AS firstname, [LNAME] AS lastname, "
+            f"[MNAME] AS middlename, [PHONE] AS phone, [EMPNAME] AS employer_name, "
+            f"[EMPCODE] AS employer_code, [DOCTYPE_NAME] AS doc_type, [EDESC] AS 'desc', "
+            f"{content_column.replace('inserted.', '')}, [FILENAME] AS filename, "
+            f"[APPLICATION_TYPE] AS application_type, [CLAIMED_BY] AS claimed_by, [doc_link] AS doc_link, "
+            f"[ATTEMPTS] AS attempts"
+        )
+        with database.time_stage('db_claim'), engine.begin() as connection:
+            return [dict(row) for row in connection.execute(query, dict(
+                params,
+                worker_id=worker_id,
+                lease_seconds=database.get_claim_lease_seconds()
+            )).mappings()]
+
+    database.create_db_engine = lambda: engine
+    database.claim_documents = claim_documents
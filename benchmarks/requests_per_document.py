@@ -0,0 +1,68 @@
+# Count SharePoint HTTP calls per document for each SHAREPOINT_UPLOAD_MODE. Batch mode
+# uploads from --workers threads so their MERGEs can share $batch requests.
+#
+#   python benchmarks/requests_per_document.py --documents 200
+#   python benchmarks/requests_per_document.py --documents 200 --workers 50
+from concurrent.futures import Future, ThreadPoolExecutor
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_sharepoint import start_fake_sharepoint  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count SharePoint HTTP calls per document')
+    parser.add_argument('--documents', type=int, default=100)
+    parser.add_argument('--size', type=int, default=64 * 1024, help='bytes per document')
+    parser.add_argument('--workers', type=int, default=8, help='documents uploaded concurrently')
+    args = parser.parse_args()
+
+    server = start_fake_sharepoint()
+    os.environ['SHAREPOINT_SITE_URL'] = f"http://127.0.0.1:{server.server_port}/sites"
+    os.environ.setdefault('SHAREPOINT_SITE_PATH', 'Bench')
+    os.environ.setdefault('SHAREPOINT_USERNAME', 'bench')
+    os.environ.setdefault('SHAREPOINT_PASSWORD', 'bench')
+    os.environ['UPLOAD_WORKERS'] = str(args.workers)
+
+    import sharepoint
+
+    library_name = 'Bench Library'
+    content = os.urandom(args.size)
+    metadata = {
+        'pin': 'PEN100000000001', 'firstname': 'Ada', 'lastname': 'Lovelace', 'middlename': 'B',
+        'phone': '0800000000', 'employer_name': 'Bench Ltd', 'employer_code': 'B001', 'doc_type': 'DMU'
+    }
+
+    print(f"{'mode':<10}{'calls/doc':>12}{'upload-path calls/doc':>24}{'docs/sec':>12}")
+    for mode in ('classic', 'expand', 'validate', 'batch'):
+        list_item_type = sharepoint.get_list_item_type(library_name)
+        server.calls.clear()
+
+        def upload(index):
+            return sharepoint.push_to_sharepoint(
+                library_name, list_item_type, f"{mode}_{index}.pdf", content, metadata, mode=mode)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for result in list(executor.map(upload, range(args.documents))):
+                # Batch mode settles once the MERGE's $batch is answered
+                link, status = result.result() if isinstance(result, Future) else result
+                if link is None:
+                    raise SystemExit(f"{mode}: {status}")
+        elapsed = time.perf_counter() - started
+
+        # MERGEs inside a $batch are counted by the server but are not HTTP calls
+        total = sum(server.calls.values()) - server.calls['batched MERGE']
+        writes = total - server.calls['contextinfo'] - server.calls['GetFolder'] - server.calls['GetByTitle']
+        print(f"{mode:<10}{total / args.documents:>12.2f}{writes / args.documents:>24.2f}"
+              f"{args.documents / elapsed:>12.1f}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
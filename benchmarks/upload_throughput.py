@@ -0,0 +1,152 @@
+# Measure the end-to-end upload loop offline: claim rows from a SQLite stand-in for
+# DB_TABLE_1, validate them and upload them to a local fake SharePoint, then report
+# docs/sec, MB/sec, peak RSS and SharePoint HTTP calls per document. The source is
+# seeded and the fake server run in child processes, so the reported RSS is the
+# migration's own.
+#
+#   python benchmarks/upload_throughput.py --documents 500 --size 262144 --workers 8
+#   python benchmarks/upload_throughput.py --latency 0.05 --throttle-rate 0.02 --max-concurrent 6
+#   python benchmarks/upload_throughput.py --source documents-from-path --duplicate-ratio 0.3
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_sharepoint import start_fake_sharepoint  # noqa: E402
+from fake_source import create_fake_source, synthetic_documents, add_documents, use_fake_source  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+
+TABLE = 'BENCH_DOCUMENTS'
+LIBRARY = 'Bench Library'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the upload loop against local stand-ins')
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--size', type=int, default=256 * 1024, help='approximate bytes per document')
+    parser.add_argument('--source', choices=['documents', 'documents-from-path'], default='documents')
+    parser.add_argument('--workers', type=int, default=8, help='UPLOAD_WORKERS')
+    parser.add_argument('--mode', choices=['classic', 'expand', 'validate', 'batch'], default='expand')
+    parser.add_argument('--png-ratio', type=float, default=0.2, help='share of documents that are PNG images')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every SharePoint response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds per response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of SharePoint requests failing with 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of SharePoint requests given a 429')
+    parser.add_argument('--max-concurrent', type=int, default=None,
+                        help='SharePoint requests served at once before 503s')
+    return parser.parse_args()
+
+
+def stage_summary(stage_seconds):
+    totals = {}
+    for name, key, extra, value in stage_seconds.samples():
+        if name.endswith('_sum'):
+            totals.setdefault(key[0], [0, 0.0])[1] = value
+        elif name.endswith('_count'):
+            totals.setdefault(key[0], [0, 0.0])[0] = value
+    return totals
+
+
+# Run the fake SharePoint until told to stop, then send back its counters
+def serve(connection, options):
+    server = start_fake_sharepoint(**options)
+    connection.send(server.server_port)
+    connection.recv()
+    server.shutdown()
+    connection.send({'requests': server.requests, 'bytes_received': server.bytes_received,
+                     'faults': dict(server.faults)})
+
+
+# Generate the synthetic documents into the table create_fake_source made
+def seed(path, args, file_dir):
+    add_documents(create_engine(f"sqlite:///{path}"), TABLE,
+                  synthetic_documents(args.documents, args.size, args.png_ratio, args.duplicate_ratio),
+                  file_dir=file_dir)
+
+
+def run_in_child(target, *args):
+    process = multiprocessing.get_context('spawn').Process(target=target, args=args)
+    process.start()
+    return process
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='upload-bench-')
+
+    connection, server_connection = multiprocessing.Pipe()
+    server = run_in_child(serve, server_connection, {
+        'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate, 'max_concurrent': args.max_concurrent
+    })
+    server_port = connection.recv()
+    # The modules read their configuration through settings.get_settings on first use, so set it up first
+    os.environ.update({
+        'SHAREPOINT_SITE_URL': f"http://127.0.0.1:{server_port}/sites",
+        'SHAREPOINT_SITE_PATH': 'Bench',
+        'SHAREPOINT_USERNAME': 'bench',
+        'SHAREPOINT_PASSWORD': 'bench',
+        'SHAREPOINT_LIBRARY_NAME_DMU': LIBRARY,
+        'SHAREPOINT_UPLOAD_MODE': args.mode,
+        'SHAREPOINT_BACKOFF_BASE_SECONDS': os.getenv('SHAREPOINT_BACKOFF_BASE_SECONDS', '0.1'),
+        'UPLOAD_WORKERS': str(args.workers),
+        'DB_TABLE_1': TABLE,
+        'FILE_BATCH_NO': str(args.documents),
+        'DEDUP_INDEX_PATH': os.path.join(workdir, 'content_index.sqlite3'),
+        'JOURNAL_DIR': os.path.join(workdir, 'journal')
+    })
+
+    source_path = os.path.join(workdir, 'source.sqlite3')
+    engine = create_fake_source(source_path, TABLE)
+    file_dir = None
+    if args.source == 'documents-from-path':
+        file_dir = os.path.join(workdir, 'share')
+        os.makedirs(file_dir)
+    seeder = run_in_child(seed, source_path, args, file_dir)
+    seeder.join()
+    if seeder.exitcode != 0:
+        raise SystemExit("Seeding the fake source failed")
+    use_fake_source(engine)
+
+    import runner
+    from jobs import MigrationJob
+    from metrics import STAGE_SECONDS
+
+    job = MigrationJob(args.source, 'dmu')
+    rss_before_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    started = time.perf_counter()
+    job.run(runner.MIGRATIONS[args.source], 'dmu', True)
+    elapsed = time.perf_counter() - started
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    connection.send('stop')
+    counters = connection.recv()
+    server.join()
+
+    snapshot = job.snapshot()
+    if snapshot['error']:
+        raise SystemExit(f"Benchmark run failed: {snapshot['error']}")
+    processed = max(snapshot['processed'], 1)
+
+    print(f"source            {args.source} ({args.mode}, {args.workers} workers)")
+    print(f"documents         {snapshot['processed']} ({snapshot['succeeded']} succeeded, "
+          f"{snapshot['duplicates']} duplicates)")
+    print(f"failed            {snapshot['failed_by_reason'] or 0}")
+    print(f"elapsed           {elapsed:.2f} s")
+    print(f"docs/sec          {snapshot['processed'] / elapsed:.1f}")
+    print(f"MB/sec            {counters['bytes_received'] / elapsed / 1e6:.2f}")
+    print(f"peak RSS          {peak_rss_mb:.1f} MB ({peak_rss_mb - rss_before_mb:+.1f} MB during the run)")
+    print(f"HTTP calls/doc    {counters['requests'] / processed:.2f}")
+    print(f"injected faults   {counters['faults'] or 0}")
+    print("stage             count     mean ms")
+    for stage, (count, total) in stage_summary(STAGE_SECONDS).items():
+        print(f"  {stage:<16}{int(count):>6}{total / count * 1000 if count else 0:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
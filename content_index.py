@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from settings import get_settings
+import hashlib
+import sqlite3
+import threading
+
+
+def is_dedup_enabled():
+    return get_settings().dedup_enabled
+
+
+# Whether a duplicate also gets its own metadata written to the existing file
+def update_duplicate_metadata():
+    return get_settings().dedup_update_metadata
+
+
+# SHA-256 of a document already in memory or memory-mapped; hashlib releases the
+# GIL on large buffers, so other uploads keep running meanwhile
+def hash_content(file_item):
+    return hashlib.sha256(file_item).hexdigest()
+
+
+# Running SHA-256 of a document streamed up in chunks; hexdigest() once it is uploaded
+# gives the same hash as hash_content
+def start_content_hash():
+    return hashlib.sha256()
+
+
+# Local on-disk index of uploaded content: (SHA-256, library, RSAPin) -> SharePoint file.
+# Lets a document whose bytes are already in the library for the same member be
+# linked to the existing file instead of being uploaded again. The pin is part of
+# the key so identical content of another member still gets its own file, findable
+# by that member's RSAPin.
+class ContentIndex:
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+        self._content_locks = {}
+        self._content_locks_lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(uploaded_content)")]
+            if columns and 'pin' not in columns:
+                # An index keyed without the pin would link members to each other's files
+                self._connection.execute("DROP TABLE uploaded_content")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS uploaded_content ("
+                "content_hash TEXT NOT NULL, library_name TEXT NOT NULL, pin TEXT NOT NULL, "
+                "file_link TEXT NOT NULL, file_url TEXT NOT NULL, item_id INTEGER, "
+                "file_size INTEGER, uploaded_at TEXT NOT NULL, "
+                "PRIMARY KEY (content_hash, library_name, pin))"
+            )
+            self._connection.commit()
+        return self._connection
+
+    # Returns a dict with file_link, file_url and item_id, or None
+    def lookup(self, content_hash, library_name, pin):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT file_link, file_url, item_id FROM uploaded_content "
+                "WHERE content_hash = ? AND library_name = ? AND pin = ?",
+                (content_hash, library_name, str(pin))
+            ).fetchone()
+        if row is None:
+            return None
+        return {'file_link': row[0], 'file_url': row[1], 'item_id': row[2]}
+
+    def record(self, content_hash, library_name, pin, file_link, file_url, item_id=None, file_size=None):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO uploaded_content "
+                "(content_hash, library_name, pin, file_link, file_url, item_id, file_size, uploaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (content_hash, library_name, str(pin), file_link, file_url, item_id, file_size,
+                 datetime.now().isoformat())
+            )
+            connection.commit()
+
+    def set_item_id(self, content_hash, library_name, pin, item_id):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "UPDATE uploaded_content SET item_id = ? WHERE content_hash = ? AND library_name = ? AND pin = ?",
+                (item_id, content_hash, library_name, str(pin))
+            )
+            connection.commit()
+
+    # Drop an entry whose SharePoint file turned out to be gone
+    def forget(self, content_hash, library_name, pin):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "DELETE FROM uploaded_content WHERE content_hash = ? AND library_name = ? AND pin = ?",
+                (content_hash, library_name, str(pin))
+            )
+            connection.commit()
+
+    # Serialise uploads of the same content within this process, so two rows sharing
+    # a scan do not both miss the index and upload it twice
+    @contextmanager
+    def hold(self, content_hash, library_name, pin):
+        key = (content_hash, library_name, str(pin))
+        with self._content_locks_lock:
+            entry = self._content_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._content_locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._content_locks[key]
+
+
+# The index at DEDUP_INDEX_PATH, shared by the whole process and opened on first use
+@lru_cache(maxsize=None)
+def get_content_index():
+    return ContentIndex(get_settings().dedup_index_path)
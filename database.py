@@ -1,63 +1,80 @@
-import pyodbc
 from sqlalchemy import create_engine, text
-import pandas as pd
-from dotenv import load_dotenv
-import os
+from functools import lru_cache
+from settings import get_settings
+from upload_engine import get_upload_workers
+from routing import get_routing_table
+from metrics import Gauge, time_stage
+from journal import get_upload_journal
+import logging
+import threading
+import time
 from urllib.parse import quote_plus
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 
-# Spool records to push into sharepoint
-def get_document_and_metadata(document_type):
-    if document_type == 'dmu':
-        document_type = 'DMU'
-    else:
-        document_type = 'CASE OR BA DOCUMENT'
-    # Create the connection string and  URL-encode the username and password
-    username = quote_plus(os.getenv('DB_USERNAME'))
-    password = quote_plus(os.getenv('DB_PASSWORD'))
-    server = os.getenv('DB_SERVER')
-    database = os.getenv('DB_DATABASE')
-    driver = quote_plus(os.getenv('DB_DRIVER'))
-    file_batch = os.getenv('FILE_BATCH_NO')
+# Connections kept open: DB_POOL_SIZE, or by default, like the SharePoint pool, one for
+# every thread of every routed library's worker pool, plus two for claims and status writes
+def get_db_pool_size():
+    if get_settings().db_pool_size:
+        return get_settings().db_pool_size
+    return (get_routing_table().get_total_concurrency() or get_upload_workers()) + 2
+
+
+# Create a SQLAlchemy engine from the DB_* environment variables
+def create_db_engine():
+    settings = get_settings()
+    missing = [name for name, value in [('DB_USERNAME', settings.db_username), ('DB_PASSWORD', settings.db_password),
+                                        ('DB_SERVER', settings.db_server), ('DB_DATABASE', settings.db_database),
+                                        ('DB_DRIVER', settings.db_driver)] if not value]
+    if missing:
+        raise Exception(f"Missing required environment variables: {', '.join(missing)}")
+
+    # URL-encode the username and password
+    username = quote_plus(settings.db_username)
+    password = quote_plus(settings.db_password)
+    server = settings.db_server
+    database = settings.db_database
+    driver = quote_plus(settings.db_driver)
 
     # Create the connection string
     conn_str = f"mssql+pyodbc://{username}:{password}@{server}/{database}?driver={driver}"
 
-    # Create the SQLAlchemy engine
-    engine = create_engine(conn_str)
+    return create_engine(
+        conn_str,
+        pool_size=get_db_pool_size(),
+        max_overflow=settings.db_max_overflow,
+        pool_recycle=settings.db_pool_recycle_seconds,
+        pool_pre_ping=True,
+        fast_executemany=True
+    )
 
-    query_table = os.getenv('DB_TABLE_1')
-    query = (f"SELECT TOP {file_batch} [FILEID] AS fileid, [RSAPIN] AS pin, [FNAME] AS firstname, "
-             f"[LNAME] AS lastname, [MNAME] AS middlename, [PHONE] AS phone, "
-             f"[EMPNAME] AS employer_name, [EMPCODE] AS employer_code, "
-             f"[DOCTYPE_NAME] AS doc_type, [EDESC] AS 'desc', [FILEITEM] AS file_item, "
-             f"[FILENAME] AS filename FROM {query_table}  WHERE [status] IS NULL "
-             f"AND [APPLICATION_TYPE] = ?")
 
-    # Use the engine to read the SQL query into a DataFrame
-    df = pd.read_sql(query, engine, params=(document_type,))
+# One engine, and so one connection pool, shared by the whole process
+_engine = None
+_engine_lock = threading.Lock()
 
-    return df
 
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_db_engine()
+    return _engine
 
-def update_document_status(ref_id, doc_link, status, filename):
-    # URL-encode the username and password
-    username = quote_plus(os.getenv('DB_USERNAME'))
-    password = quote_plus(os.getenv('DB_PASSWORD'))
-    server = os.getenv('DB_SERVER')
-    database = os.getenv('DB_DATABASE')
-    driver = quote_plus(os.getenv('DB_DRIVER'))
 
-    # Create the connection string
-    conn_str = f"mssql+pyodbc://{username}:{password}@{server}/{database}?driver={driver}"
+# Pool usage is only reported once the engine exists; rendering metrics never connects
+DB_POOL_CHECKED_OUT = Gauge('db_pool_checked_out_connections', 'Database connections currently in use',
+                            function=lambda: _engine.pool.checkedout() if _engine is not None else None)
+DB_POOL_SIZE = Gauge('db_pool_size', 'Database connections kept open by the pool',
+                     function=lambda: _engine.pool.size() if _engine is not None else None)
+
 
-    # Create the SQLAlchemy engine
-    engine = create_engine(conn_str)
+# Write many (ref_id, doc_link, status, filename) updates in one executemany round trip
+def update_document_statuses(updates):
+    engine = get_engine()
 
-    query_table = os.getenv('DB_TABLE_1')
+    query_table = get_settings().db_table
 
     # Define the query using SQLAlchemy's text function
     query = text(
@@ -66,15 +83,277 @@ def update_document_status(ref_id, doc_link, status, filename):
     )
 
     # Execute the query with parameters
-    with engine.connect() as connection:
-        connection.execute(query, {
-            'doc_link': doc_link,
-            'status': status,
-            'filename': filename,
-            'ref_id': ref_id
-        })
+    with time_stage('status_write'), engine.connect() as connection:
+        connection.execute(query, [
+            {'doc_link': doc_link, 'status': status, 'filename': filename, 'ref_id': ref_id}
+            for ref_id, doc_link, status, filename in updates
+        ])
         connection.commit()
+    get_upload_journal().committed(updates)
+
+
+# Buffers status updates and flushes them with update_document_statuses every
+# batch_size rows or every flush_seconds, whichever comes first
+class StatusWriter:
+    def __init__(self, batch_size=None, flush_seconds=None):
+        self.batch_size = batch_size or get_settings().db_status_batch_size
+        self.flush_seconds = flush_seconds or get_settings().db_status_flush_seconds
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, ref_id, doc_link, status, filename):
+        with self._lock:
+            self._pending.append((ref_id, doc_link, status, filename))
+            full = len(self._pending) >= self.batch_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_periodically, name='status-writer', daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                updates, self._pending = self._pending, []
+            if not updates:
+                return
+            try:
+                update_document_statuses(updates)
+            except Exception:
+                # Keep the updates for the next flush rather than losing them
+                with self._lock:
+                    self._pending = updates + self._pending
+                raise
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush document statuses")
+
+
+# The process's status writer, created on first use so importing reads no settings
+@lru_cache(maxsize=None)
+def get_status_writer():
+    return StatusWriter()
 
 
-def get_documents_with_file_path(document_type):
-    pass
+# Buffered variant of update_document_statuses; call flush_document_statuses() at the end of a batch
+def queue_document_status(ref_id, doc_link, status, filename):
+    get_status_writer().add(ref_id, doc_link, status, filename)
+
+
+def flush_document_statuses():
+    get_status_writer().flush()
+
+
+def get_claim_lease_seconds():
+    return get_settings().db_claim_lease_seconds
+
+
+# Rows migrated per run when it does not drain the table
+def get_file_batch_no():
+    if get_settings().file_batch_no is None:
+        raise Exception("Missing required environment variable: FILE_BATCH_NO")
+    return get_settings().file_batch_no
+
+
+# SQL condition and parameters matching the rows of a routing.RoutingTable's selectors.
+# Each selector is (application_type, doc_type, excluded_doc_types); a doc_type of
+# None matches every DOCTYPE_NAME except the excluded ones.
+def build_selector_filter(selectors):
+    clauses = []
+    params = {}
+    for i, (application_type, doc_type, excluded_doc_types) in enumerate(selectors):
+        params[f'application_type_{i}'] = application_type
+        clause = f"[APPLICATION_TYPE] = :application_type_{i}"
+        if doc_type is not None:
+            params[f'doc_type_{i}'] = doc_type
+            clause += f" AND [DOCTYPE_NAME] = :doc_type_{i}"
+        elif excluded_doc_types:
+            names = []
+            for j, excluded in enumerate(excluded_doc_types):
+                params[f'excluded_{i}_{j}'] = excluded
+                names.append(f":excluded_{i}_{j}")
+            clause += f" AND ([DOCTYPE_NAME] IS NULL OR [DOCTYPE_NAME] NOT IN ({', '.join(names)}))"
+        clauses.append(f"({clause})")
+    if not clauses:
+        return "1 = 0", params
+    return f"({' OR '.join(clauses)})", params
+
+
+# Claim up to batch_size pending rows matching selectors for worker_id and return their
+# metadata plus content_column. The UPDATE ... OUTPUT runs under UPDLOCK/READPAST, so
+# concurrent claimers on any host skip each other's rows instead of picking them up
+# twice. Rows whose lease has expired (e.g. from a crashed worker) can be claimed again.
+def claim_documents(selectors, worker_id, batch_size, content_column):
+    selector_filter, params = build_selector_filter(selectors)
+    query_table = get_settings().db_table
+    query = text(
+        f"WITH batch AS ("
+        f"SELECT TOP ({int(batch_size)}) * FROM {query_table} WITH (UPDLOCK, READPAST, ROWLOCK) "
+        f"WHERE [status] IS NULL AND {selector_filter} "
+        f"AND ([CLAIMED_BY] IS NULL OR [LEASE_EXPIRES] < SYSUTCDATETIME()) "
+        f"ORDER BY [FILEID], [FILENAME]) "
+        f"UPDATE batch SET [CLAIMED_BY] = :worker_id, "
+        f"[LEASE_EXPIRES] = DATEADD(second, :lease_seconds, SYSUTCDATETIME()) "
+        f"OUTPUT inserted.[FILEID] AS fileid, inserted.[RSAPIN] AS pin, inserted.[FNAME] AS firstname, "
+        f"inserted.[LNAME] AS lastname, inserted.[MNAME] AS middlename, inserted.[PHONE] AS phone, "
+        f"inserted.[EMPNAME] AS employer_name, inserted.[EMPCODE] AS employer_code, "
+        f"inserted.[DOCTYPE_NAME] AS doc_type, inserted.[EDESC] AS 'desc', {content_column}, "
+        f"inserted.[FILENAME] AS filename, inserted.[APPLICATION_TYPE] AS application_type, "
+        f"inserted.[CLAIMED_BY] AS claimed_by, inserted.[doc_link] AS doc_link, inserted.[ATTEMPTS] AS attempts"
+    )
+    with time_stage('db_claim'), get_engine().begin() as connection:
+        return [dict(row) for row in connection.execute(query, dict(
+            params,
+            worker_id=worker_id,
+            lease_seconds=get_claim_lease_seconds()
+        )).mappings()]
+
+
+# Claim one row for worker_id if it is still pending and not held by a live worker
+# other than previous_worker_id. Used to take over the rows of a crashed worker
+# without waiting for their leases to expire. Returns whether the row was claimed.
+def reclaim_document(ref_id, filename, worker_id, previous_worker_id=None):
+    query_table = get_settings().db_table
+    query = text(
+        f"UPDATE {query_table} SET [CLAIMED_BY] = :worker_id, "
+        f"[LEASE_EXPIRES] = DATEADD(second, :lease_seconds, SYSUTCDATETIME()) "
+        f"WHERE [FILEID] = :ref_id AND [FILENAME] = :filename AND [status] IS NULL "
+        f"AND ([CLAIMED_BY] IS NULL OR [CLAIMED_BY] = :previous_worker_id "
+        f"OR [LEASE_EXPIRES] < SYSUTCDATETIME())"
+    )
+    with get_engine().begin() as connection:
+        return connection.execute(query, {
+            'ref_id': ref_id,
+            'filename': filename,
+            'worker_id': worker_id,
+            'previous_worker_id': previous_worker_id,
+            'lease_seconds': get_claim_lease_seconds()
+        }).rowcount == 1
+
+
+# Remember that a row's upload was deferred for the attempts-th time
+def record_upload_attempts(ref_id, filename, attempts):
+    query_table = get_settings().db_table
+    query = text(f"UPDATE {query_table} SET [ATTEMPTS] = :attempts WHERE [FILEID] = :ref_id AND [FILENAME] = :filename")
+    with get_engine().begin() as connection:
+        connection.execute(query, {'ref_id': ref_id, 'filename': filename, 'attempts': attempts})
+
+
+# Extend the lease on every row worker_id still holds
+def renew_claims(worker_id):
+    query_table = get_settings().db_table
+    query = text(
+        f"UPDATE {query_table} SET [LEASE_EXPIRES] = DATEADD(second, :lease_seconds, SYSUTCDATETIME()) "
+        f"WHERE [CLAIMED_BY] = :worker_id AND [status] IS NULL"
+    )
+    with get_engine().begin() as connection:
+        connection.execute(query, {'worker_id': worker_id, 'lease_seconds': get_claim_lease_seconds()})
+
+
+# Hand back rows worker_id claimed but did not finish, e.g. after a cancel
+def release_claims(worker_id):
+    query_table = get_settings().db_table
+    query = text(
+        f"UPDATE {query_table} SET [CLAIMED_BY] = NULL, [LEASE_EXPIRES] = NULL "
+        f"WHERE [CLAIMED_BY] = :worker_id AND [status] IS NULL"
+    )
+    with get_engine().begin() as connection:
+        connection.execute(query, {'worker_id': worker_id})
+
+
+# Claim and stream pending rows matching selectors in chunks of DB_FETCH_CHUNK_SIZE. Stops
+# after FILE_BATCH_NO rows, or keeps claiming until the table is drained when drain is set.
+def _iter_pending_documents(selectors, worker_id, content_column, chunk_size=None, drain=False):
+    chunk_size = chunk_size or get_settings().db_fetch_chunk_size
+    remaining = None if drain else get_file_batch_no()
+
+    while remaining is None or remaining > 0:
+        batch_size = chunk_size if remaining is None else min(chunk_size, remaining)
+        rows = claim_documents(selectors, worker_id, batch_size, content_column)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+# Number of claimable pending documents matching selectors, capped at FILE_BATCH_NO unless draining
+def count_pending_documents(selectors, drain=False):
+    selector_filter, params = build_selector_filter(selectors)
+    query_table = get_settings().db_table
+    query = text(
+        f"SELECT COUNT(*) FROM {query_table} WHERE [status] IS NULL "
+        f"AND {selector_filter} "
+        f"AND ([CLAIMED_BY] IS NULL OR [LEASE_EXPIRES] < SYSUTCDATETIME())"
+    )
+    with get_engine().connect() as connection:
+        pending = connection.execute(query, params).scalar()
+    if drain:
+        return pending
+    return min(pending, get_file_batch_no())
+
+
+# Claim and stream the metadata of pending documents stored as blobs, without the
+# blobs; each blob is read later by fetch_document_blob
+def iter_document_metadata(selectors, worker_id, chunk_size=None, drain=False):
+    return _iter_pending_documents(selectors, worker_id, "DATALENGTH(inserted.[FILEITEM]) AS file_size",
+                                   chunk_size, drain)
+
+
+# Read one document's blob when its upload starts
+def fetch_document_blob(ref_id, filename):
+    engine = get_engine()
+    query_table = get_settings().db_table
+    query = text(f"SELECT [FILEITEM] FROM {query_table} WHERE [FILEID] = :ref_id AND [FILENAME] = :filename")
+    with time_stage('db_read'), engine.connect() as connection:
+        file_item = connection.execute(query, {'ref_id': ref_id, 'filename': filename}).scalar()
+    return file_item
+
+
+# Read part of a document's blob, for chunked uploads of large files
+def read_document_blob_chunk(ref_id, filename, offset, size):
+    engine = get_engine()
+    query_table = get_settings().db_table
+    query = text(
+        f"SELECT SUBSTRING([FILEITEM], :start, :length) FROM {query_table} "
+        f"WHERE [FILEID] = :ref_id AND [FILENAME] = :filename"
+    )
+    with time_stage('db_read'), engine.connect() as connection:
+        chunk = connection.execute(query, {
+            'start': offset + 1,  # SUBSTRING is 1-based
+            'length': size,
+            'ref_id': ref_id,
+            'filename': filename
+        }).scalar()
+    return chunk
+
+
+# Claim and stream the metadata and file share path of pending documents stored on disk
+def get_documents_with_file_path(selectors, worker_id, chunk_size=None, drain=False):
+    return _iter_pending_documents(selectors, worker_id, "inserted.[FILE_PATH] AS file_path", chunk_size, drain)
+
+
+# Stream every row that has a SharePoint link, in lists of up to chunk_size rows,
+# with the metadata columns under the names push_to_sharepoint takes them by.
+# Used by reconcile.py to compare the table with the libraries.
+def iter_linked_documents(chunk_size=None):
+    chunk_size = chunk_size or get_settings().db_fetch_chunk_size
+    query_table = get_settings().db_table
+    query = text(
+        f"SELECT [FILEID] AS fileid, [FILENAME] AS filename, [status] AS status, [doc_link] AS doc_link, "
+        f"[RSAPIN] AS pin, [FNAME] AS firstname, [LNAME] AS lastname, [MNAME] AS middlename, [PHONE] AS phone, "
+        f"[EMPNAME] AS employer_name, [EMPCODE] AS employer_code, [DOCTYPE_NAME] AS doc_type "
+        f"FROM {query_table} WHERE [doc_link] IS NOT NULL"
+    )
+    with get_engine().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        for rows in result.mappings().partitions(chunk_size):
+            yield [dict(row) for row in rows]
@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+from validation import start_file_validation
+from metrics import time_stage
+import mmap
+import os
+
+# File extensions accepted from the file share
+VALID_EXTENSIONS = [
+    '.jpeg', '.jpg', '.png', '.bmp', '.gif', '.pdf', '.doc', '.docx', '.xls', '.xlsx'
+]
+
+
+# Check a file on the share before it reaches an upload worker.
+# Returns the file size, or None and the failure status.
+def prescan_file(file_path):
+    # Check if the file exists; one stat call also gives the size
+    try:
+        file_size = os.stat(file_path).st_size
+    except OSError:
+        return None, "File not found"
+
+    # Check the file extension and validate file types
+    ext = os.path.splitext(os.path.basename(file_path))[1].lower()
+    if ext not in VALID_EXTENSIONS:
+        return None, f"Unsupported file type: {ext}"
+
+    return file_size, None
+
+
+# Pre-scan stage for rows from get_documents_with_file_path: adds file_size and
+# prescan_status (None when the file can be uploaded) to each row. Files that pass
+# also get validation, a Future for their content check, which starts here so it
+# runs in the validation pool while earlier documents are uploading.
+def prescan_documents(rows):
+    for row in rows:
+        row = dict(row)
+        with time_stage('prescan'):
+            row['file_size'], row['prescan_status'] = prescan_file(row['file_path'])
+            row['validation'] = None if row['prescan_status'] else start_file_validation(row['file_path'])
+        yield row
+
+
+# Memory-map a file read-only; the map can be sent as a request body or sliced
+# into chunks without copying the whole file into the process
+@contextmanager
+def open_mapped_file(file_path):
+    with open(file_path, 'rb') as file:
+        # mmap cannot map an empty file
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
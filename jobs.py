@@ -0,0 +1,176 @@
+from collections import Counter, OrderedDict
+from datetime import datetime
+from settings import get_settings
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+SUCCESS_STATUS = "Uploaded successfully"
+
+# Status of a document linked to content already in the library instead of uploaded
+DUPLICATE_STATUS = "Duplicate of uploaded document"
+
+
+# A migration run executing on a background thread, with live counters that
+# the API can poll and pause/resume/cancel controls checked between documents
+class MigrationJob:
+    def __init__(self, kind, document_type):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.document_type = document_type
+        self.state = 'queued'
+        self.error = None
+        self.total = None
+        self.processed = 0
+        self.succeeded = 0
+        self.duplicates = 0
+        self.failed_by_reason = Counter()
+        self.bytes_uploaded = 0
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._cancelled = threading.Event()
+        self._started = None
+        self._finished = None
+        self._paused_seconds = 0.0
+        self._paused_at = None
+
+    # Called by the upload engine before it takes the next document.
+    # Blocks while the job is paused; returns False once it is cancelled.
+    def checkpoint(self):
+        while not self._resumed.wait(timeout=1):
+            if self._cancelled.is_set():
+                break
+        return not self._cancelled.is_set()
+
+    def record(self, status, file_size=None):
+        with self._lock:
+            self.processed += 1
+            if status == SUCCESS_STATUS:
+                self.succeeded += 1
+                self.bytes_uploaded += file_size or 0
+            elif status == DUPLICATE_STATUS:
+                self.succeeded += 1
+                self.duplicates += 1
+            else:
+                # Group failures by the reason before the detail, e.g. "Failed to upload"
+                self.failed_by_reason[str(status).split(':', 1)[0]] += 1
+
+    def pause(self):
+        with self._lock:
+            if self.state == 'running':
+                self.state = 'paused'
+                self._paused_at = time.monotonic()
+                self._resumed.clear()
+
+    def resume(self):
+        with self._lock:
+            if self.state == 'paused':
+                self.state = 'running'
+                self._paused_seconds += time.monotonic() - self._paused_at
+                self._paused_at = None
+                self._resumed.set()
+
+    def cancel(self):
+        with self._lock:
+            if self.state in ('queued', 'running', 'paused'):
+                if self._paused_at is not None:
+                    self._paused_seconds += time.monotonic() - self._paused_at
+                    self._paused_at = None
+                self.state = 'cancelling'
+                self._cancelled.set()
+                self._resumed.set()
+
+    def is_finished(self):
+        return self.state in ('completed', 'cancelled', 'failed')
+
+    def run(self, target, *args):
+        with self._lock:
+            if self._cancelled.is_set():
+                self.state = 'cancelled'
+                self.finished_at = datetime.now()
+                return
+            self.state = 'running'
+            self.started_at = datetime.now()
+            self._started = time.monotonic()
+        try:
+            target(self, *args)
+            final_state, error = ('cancelled' if self._cancelled.is_set() else 'completed'), None
+        except Exception as e:
+            logger.exception("Migration job %s failed", self.id)
+            final_state, error = 'failed', str(e)
+        with self._lock:
+            self.state = final_state
+            self.error = error
+            self.finished_at = datetime.now()
+            self._finished = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = None
+            if self._started is not None:
+                end = self._finished or self._paused_at or time.monotonic()
+                elapsed = max(end - self._started - self._paused_seconds, 1e-6)
+
+            docs_per_second = self.processed / elapsed if elapsed else 0.0
+            eta_seconds = None
+            if self.total is not None and docs_per_second and not self.is_finished():
+                eta_seconds = round(max(self.total - self.processed, 0) / docs_per_second, 1)
+
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "document_type": self.document_type,
+                "state": self.state,
+                "error": self.error,
+                "total": self.total,
+                "processed": self.processed,
+                "succeeded": self.succeeded,
+                "duplicates": self.duplicates,
+                "failed": self.processed - self.succeeded,
+                "failed_by_reason": dict(self.failed_by_reason),
+                "bytes_uploaded": self.bytes_uploaded,
+                "bytes_per_second": round(self.bytes_uploaded / elapsed, 1) if elapsed else 0.0,
+                "documents_per_second": round(docs_per_second, 2),
+                "eta_seconds": eta_seconds,
+                "created_at": self.created_at.isoformat(),
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None
+            }
+
+
+# Jobs of this process only, which is why the API runs as a single uvicorn worker
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+# Create a job and run target(job, *args) for it on a background thread
+def start_job(kind, document_type, target, *args):
+    job = MigrationJob(kind, document_type)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        _prune_finished_jobs()
+    threading.Thread(target=job.run, args=(target,) + args, name=f"job-{job.id[:8]}", daemon=True).start()
+    return job
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def list_jobs():
+    with _jobs_lock:
+        return list(_jobs.values())
+
+
+def _prune_finished_jobs():
+    finished = [job_id for job_id, job in _jobs.items() if job.is_finished()]
+    for job_id in finished[:max(len(finished) - get_settings().job_history_limit, 0)]:
+        del _jobs[job_id]
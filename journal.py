@@ -0,0 +1,230 @@
+from datetime import datetime
+from functools import lru_cache
+from settings import get_settings
+import fcntl
+import glob
+import json
+import os
+import socket
+import threading
+import uuid
+
+# Stages a document passes through once a worker starts uploading it
+CLAIMED = 'claimed'
+UPLOADED = 'uploaded'
+METADATA_SET = 'metadata_set'
+COMMITTED = 'committed'
+
+
+def is_journal_enabled():
+    return get_settings().journal_enabled
+
+
+# Key of a document in DB_TABLE_1, the same pair its status is written by
+def document_key(file_id, filename):
+    return f"{file_id}/{filename}"
+
+
+# Replay a journal file into the last known state, by key, of each document whose
+# status was not committed. A torn last line, from a crash mid-write, is ignored.
+def read_journal(path):
+    documents = {}
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record['stage'] == COMMITTED:
+                documents.pop(record['key'], None)
+            elif record['stage'] == CLAIMED:
+                # A document claimed again after a deferred upload starts over
+                documents[record['key']] = record
+            else:
+                documents.setdefault(record['key'], {}).update(record)
+    return documents
+
+
+# Append-only, fsync'd write-ahead journal of the documents this process is uploading.
+# Each document gets a record as it is claimed for upload (with the file it will be
+# uploaded as), once the file is in SharePoint, once its metadata is set and once its
+# status is committed to the database. After a crash, resume_journaled_uploads finishes
+# what the records show was left undone instead of uploading the document again.
+#
+# Every process writes its own file in JOURNAL_DIR and holds an exclusive lock on it
+# while it runs; a journal whose lock can be taken belongs to a process that is gone.
+class UploadJournal:
+    def __init__(self, directory):
+        self.directory = directory
+        # The random part keeps a restarted container, which often gets the same pid,
+        # from appending to the journal of the process it replaced
+        self.name = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._file = None
+        self._lock_file = None
+        self._open = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._size = 0
+        self._written = 0
+        self._synced = 0
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"{self.name}.log")
+
+    def _open_file(self):
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_file = open(os.path.join(self.directory, f"{self.name}.lock"), 'w')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._file = open(self.path, 'a')
+            self._size = self._file.tell()
+        return self._file
+
+    # Write the records, then fsync. Threads arriving while another is in fsync
+    # share the next one, so concurrent uploads do not each wait for the disk.
+    def _append(self, records):
+        with self._lock:
+            data = ''.join(json.dumps(record) + '\n' for record in records)
+            file = self._open_file()
+            file.write(data)
+            file.flush()
+            self._size += len(data)
+            self._written += 1
+            target = self._written
+        with self._sync_lock:
+            if self._synced >= target:
+                return
+            with self._lock:
+                written = self._written
+                fd = self._file.fileno()
+            os.fsync(fd)
+            self._synced = written
+        self._compact_if_large()
+
+    # Rewrite the journal with the records of documents not yet committed
+    def _compact_if_large(self):
+        if self._size < get_settings().journal_compact_bytes:
+            return
+        with self._sync_lock, self._lock:
+            if self._size < get_settings().journal_compact_bytes:
+                return
+            compacted = f"{self.path}.compact"
+            with open(compacted, 'w') as file:
+                file.write(''.join(json.dumps(record) + '\n' for record in self._open.values()))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(compacted, self.path)
+            self._file.close()
+            self._file = open(self.path, 'a')
+            self._size = self._file.tell()
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    # Record that row is about to be uploaded to file_url in library_name
+    def claimed(self, row, file_id, filename, worker_id, library_name, folder, file_url, file_size,
+                content_hash=None):
+        if not is_journal_enabled():
+            return
+        record = {
+            'stage': CLAIMED,
+            'key': document_key(file_id, filename),
+            'file_id': file_id,
+            'filename': filename,
+            'worker_id': worker_id,
+            'library_name': library_name,
+            'folder': folder,
+            'file_url': file_url,
+            'file_size': file_size,
+            'content_hash': content_hash,
+            'metadata': {name: row.get(name) for name in ('pin', 'firstname', 'lastname', 'middlename', 'phone',
+                                                          'employer_name', 'employer_code', 'doc_type')},
+            'at': datetime.now().isoformat()
+        }
+        with self._lock:
+            self._open[record['key']] = dict(record)
+        self._append([record])
+
+    def _advance(self, file_id, filename, stage, **fields):
+        if not is_journal_enabled():
+            return
+        key = document_key(file_id, filename)
+        record = dict(fields, stage=stage, key=key)
+        with self._lock:
+            if key not in self._open:
+                return
+            self._open[key].update(record)
+        self._append([record])
+
+    # The file is in SharePoint; item_id is None when the upload response did not carry it.
+    # content_hash is given for content hashed while it was uploaded.
+    def uploaded(self, file_id, filename, file_url, item_id=None, content_hash=None):
+        fields = {'content_hash': content_hash} if content_hash else {}
+        self._advance(file_id, filename, UPLOADED, file_url=file_url, item_id=item_id, **fields)
+
+    def metadata_set(self, file_id, filename, file_link):
+        self._advance(file_id, filename, METADATA_SET, file_link=file_link)
+
+    # The (ref_id, doc_link, status, filename) updates were written to the database
+    def committed(self, updates):
+        if not is_journal_enabled():
+            return
+        records = []
+        with self._lock:
+            for ref_id, doc_link, status, filename in updates:
+                if status is None:
+                    # Only the link of a file still waiting for its metadata; the document stays open
+                    continue
+                key = document_key(ref_id, filename)
+                if self._open.pop(key, None) is not None:
+                    records.append({'stage': COMMITTED, 'key': key})
+        if records:
+            self._append(records)
+
+    # Drop a document whose upload failed before it reached SharePoint. One that got
+    # further stays open, so a replay finishes it rather than uploading it again.
+    def abandon(self, file_id, filename):
+        key = document_key(file_id, filename)
+        with self._lock:
+            if key in self._open and self._open[key]['stage'] == CLAIMED:
+                del self._open[key]
+
+    # Journals left by processes that have exited, each locked for the caller; call
+    # remove_orphan once it has been replayed
+    def orphaned_journals(self):
+        orphans = []
+        for lock_path in glob.glob(os.path.join(self.directory, '*.lock')):
+            name = os.path.basename(lock_path)[:-len('.lock')]
+            if name == self.name:
+                continue
+            lock_file = open(lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Still held by a running process
+                lock_file.close()
+                continue
+            path = os.path.join(self.directory, f"{name}.log")
+            if not os.path.exists(path):
+                # Already replayed and removed by another process
+                self.remove_orphan(path, lock_file)
+                continue
+            orphans.append((path, lock_file))
+        return orphans
+
+    def remove_orphan(self, path, lock_file):
+        for stale in (path, f"{path}.compact", lock_file.name):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+        lock_file.close()
+
+
+# This process's journal in JOURNAL_DIR, created on first use
+@lru_cache(maxsize=None)
+def get_upload_journal():
+    return UploadJournal(get_settings().journal_dir)
@@ -0,0 +1,198 @@
+from contextlib import contextmanager
+from functools import lru_cache
+from settings import get_settings
+import threading
+import time
+
+
+# Per-document spans are optional: they need the opentelemetry packages and TRACING_ENABLED.
+# Returns None when tracing is off.
+@lru_cache(maxsize=None)
+def get_tracer():
+    if not get_settings().tracing_enabled:
+        return None
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    return trace.get_tracer('sharepoint_migration')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+# Minimal Prometheus metric types, rendered in the text exposition format by render().
+# Labels are passed as keyword arguments, e.g. documents.inc(outcome='Uploaded successfully').
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+# A gauge is either set directly, or read from function() each time metrics are rendered
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        return [] if value is None else [(self.name, (), None, value)]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            for bound, count in zip(self.buckets, counts):
+                samples.append((f"{self.name}_bucket", key, [('le', _format_value(bound))], count))
+            samples.append((f"{self.name}_sum", key, None, total))
+            samples.append((f"{self.name}_count", key, None, counts[-1]))
+        return samples
+
+
+# Every registered metric in the Prometheus text format
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram(
+    'migration_stage_duration_seconds',
+    'Time spent in each stage of migrating a document',
+    ['stage']
+)
+DOCUMENTS = Counter('migration_documents_total', 'Documents processed, by outcome', ['outcome'])
+BYTES_UPLOADED = Counter('migration_bytes_uploaded_total', 'Document bytes uploaded to SharePoint')
+UPLOADS_IN_FLIGHT = Gauge('migration_uploads_in_flight', 'Documents currently being processed by upload workers')
+
+
+# Time a stage into STAGE_SECONDS, and as a child span of the document's span when tracing.
+# Stages: db_claim, db_read, prescan, validation, hash, digest, upload, item_lookup,
+# metadata_update, status_write.
+@contextmanager
+def time_stage(stage):
+    started = time.perf_counter()
+    tracer = get_tracer()
+    try:
+        if tracer is None:
+            yield
+        else:
+            with tracer.start_as_current_span(stage):
+                yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+# Span around all the stages of one document; a no-op unless tracing is enabled
+@contextmanager
+def document_span(row):
+    tracer = get_tracer()
+    if tracer is None:
+        yield
+        return
+    with tracer.start_as_current_span('document') as span:
+        span.set_attribute('fileid', str(row.get('fileid')))
+        span.set_attribute('filename', str(row.get('filename') or row.get('file_path')))
+        yield
+
+
+# Count a finished document by its outcome, the status before any ':' detail
+def record_document(status, file_size=None, uploaded=False):
+    DOCUMENTS.inc(outcome=str(status).split(':', 1)[0])
+    if uploaded:
+        BYTES_UPLOADED.inc(file_size or 0)
@@ -0,0 +1,289 @@
+from sharepoint import send_request, get_concurrency_controller, get_folder_url, get_list_item_type, build_field_values
+from database import iter_linked_documents
+from routing import get_routing_table
+from settings import get_settings
+from upload_engine import run_bounded, get_upload_workers
+from jobs import SUCCESS_STATUS
+import argparse
+import csv
+import os
+import sqlite3
+import threading
+from urllib.parse import unquote, urljoin, urlsplit
+
+# Metadata columns of DB_TABLE_1, as named by build_field_values, and the
+# SharePoint field each one is written to
+METADATA_COLUMNS = ('pin', 'firstname', 'lastname', 'middlename', 'phone', 'employer_name', 'employer_code',
+                    'doc_type')
+METADATA_FIELDS = {column: field for field, column in build_field_values({c: c for c in METADATA_COLUMNS}).items()}
+
+# SharePoint caps list item pages at 5000 rows
+DEFAULT_PAGE_SIZE = 5000
+
+
+# Values are compared as stripped text, so a PHONE stored as a number still matches
+def normalize(value):
+    return '' if value is None else str(value).strip()
+
+
+# On-disk index of the library items and of the DB_TABLE_1 rows linking to them. Both
+# sides are streamed into SQLite page by page and compared with joins there, so memory
+# stays bounded however many items the libraries hold.
+class ReconcileIndex:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        fields = ''.join(f", [{field}] TEXT" for field in METADATA_FIELDS.values())
+        columns = ''.join(f", [{column}] TEXT" for column in METADATA_COLUMNS)
+        self._connection.executescript(
+            f"CREATE TABLE IF NOT EXISTS library_items ("
+            f"library_name TEXT NOT NULL, item_id INTEGER NOT NULL, file_ref TEXT NOT NULL, "
+            f"filename TEXT, file_size INTEGER{fields}, PRIMARY KEY (library_name, item_id));"
+            f"CREATE INDEX IF NOT EXISTS library_items_file_ref ON library_items (file_ref);"
+            f"CREATE INDEX IF NOT EXISTS library_items_content ON library_items "
+            f"(library_name, [RSAPin], [DocumentType], file_size);"
+            f"CREATE TABLE IF NOT EXISTS documents ("
+            f"file_id TEXT, filename TEXT, status TEXT, doc_link TEXT, library_name TEXT, file_ref TEXT{columns});"
+            f"CREATE INDEX IF NOT EXISTS documents_file_ref ON documents (file_ref);"
+        )
+        self._connection.commit()
+
+    def clear_library(self, library_name):
+        with self._lock:
+            self._connection.execute("DELETE FROM library_items WHERE library_name = ?", (library_name,))
+            self._connection.commit()
+
+    def add_items(self, library_name, items):
+        placeholders = ', '.join('?' * (5 + len(METADATA_FIELDS)))
+        fields = ''.join(f", [{field}]" for field in METADATA_FIELDS.values())
+        with self._lock:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO library_items "
+                f"(library_name, item_id, file_ref, filename, file_size{fields}) VALUES ({placeholders})",
+                [(library_name, item['ID'], item['FileRef'], item['FileLeafRef'], item['file_size'],
+                  *(normalize(item.get(field)) for field in METADATA_FIELDS.values())) for item in items]
+            )
+            self._connection.commit()
+
+    def clear_documents(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM documents")
+            self._connection.commit()
+
+    def add_documents(self, rows):
+        placeholders = ', '.join('?' * (6 + len(METADATA_COLUMNS)))
+        columns = ''.join(f", [{column}]" for column in METADATA_COLUMNS)
+        with self._lock:
+            self._connection.executemany(
+                f"INSERT INTO documents (file_id, filename, status, doc_link, library_name, file_ref{columns}) "
+                f"VALUES ({placeholders})",
+                [(str(row['fileid']), row['filename'], row['status'], row['doc_link'], row['library_name'],
+                  row['file_ref'], *(normalize(row[column]) for column in METADATA_COLUMNS)) for row in rows]
+            )
+            self._connection.commit()
+
+    def query(self, sql, params=()):
+        return self._connection.execute(sql, params)
+
+    def close(self):
+        self._connection.close()
+
+
+def get_items_url(library_name):
+    return urljoin(get_settings().site_url, f"_api/web/lists/GetByTitle('{library_name}')/items")
+
+
+def get_list_items(url, params=None):
+    response = send_request('GET', url, params=params, headers={"accept": "application/json;odata=verbose"})
+    if response.status_code != 200:
+        raise Exception(f"Failed to fetch list items: {response.status_code}, {response.text}")
+    return response.json()['d']
+
+
+# Highest item ID in the library, or 0 when it is empty
+def get_max_item_id(library_name):
+    page = get_list_items(get_items_url(library_name), {'$select': 'ID', '$orderby': 'ID desc', '$top': '1'})
+    return page['results'][0]['ID'] if page['results'] else 0
+
+
+# Fetch the items with first_id < ID <= last_id, following __next when SharePoint
+# returns fewer rows per page than asked for. The ID filter keeps pages from running
+# into the next range, and paging stops once last_id is reached. Folders are left out.
+def fetch_item_range(library_name, first_id, last_id, page_size):
+    select = ['ID', 'FileRef', 'FileLeafRef', 'FSObjType', 'File/Length', *METADATA_FIELDS.values()]
+    params = {
+        '$select': ','.join(select),
+        '$expand': 'File',
+        '$filter': f"ID le {last_id}",
+        '$top': str(page_size),
+        '$skiptoken': f"Paged=TRUE&p_ID={first_id}"
+    }
+    url = get_items_url(library_name)
+    items = []
+    while url:
+        page = get_list_items(url, params)
+        for item in page['results']:
+            if item['ID'] > last_id:
+                return items
+            if str(item.get('FSObjType')) == '1':
+                continue
+            item['file_size'] = int(item['File']['Length']) if item.get('File') else None
+            items.append(item)
+        if not page['results'] or page['results'][-1]['ID'] >= last_id:
+            break
+        url, params = page.get('__next'), None
+    return items
+
+
+# Page through the whole library into the index. The ID space is split into ranges of
+# page_size IDs, each a $skiptoken page of its own, so pages are fetched concurrently
+# instead of one __next after another. Returns the number of items indexed.
+def index_library(index, library_name, page_size=DEFAULT_PAGE_SIZE, max_workers=None):
+    index.clear_library(library_name)
+    max_item_id = get_max_item_id(library_name)
+    ranges = [(first_id, min(first_id + page_size, max_item_id)) for first_id in range(0, max_item_id, page_size)]
+
+    def fetch(item_range):
+        try:
+            items = fetch_item_range(library_name, item_range[0], item_range[1], page_size)
+        except Exception as e:
+            return e
+        index.add_items(library_name, items)
+        return len(items)
+
+    max_workers = max_workers or get_routing_table().get_max_concurrency(library_name) or get_upload_workers()
+    results = run_bounded(ranges, fetch, max_workers=max_workers, limiter=get_concurrency_controller())
+    failures = [result for result in results if isinstance(result, Exception)]
+    if failures:
+        raise Exception(f"Failed to fetch {len(failures)} of {len(ranges)} pages of {library_name}: {failures[0]}")
+    return sum(results)
+
+
+# Copy the DB_TABLE_1 rows with a doc_link into the index, with the server-relative
+# file URL and library each link points to
+def index_documents(index, library_names):
+    index.clear_documents()
+    prefixes = [(unquote(get_folder_url(library_name)) + '/', library_name) for library_name in library_names]
+    count = 0
+    for rows in iter_linked_documents():
+        for row in rows:
+            row['file_ref'] = unquote(urlsplit(row['doc_link']).path)
+            row['library_name'] = next((library_name for prefix, library_name in prefixes
+                                        if row['file_ref'].startswith(prefix)), None)
+        index.add_documents(rows)
+        count += len(rows)
+    return count
+
+
+def write_report(path, header, rows):
+    count = 0
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+# Rows linking to a file that is not in its library
+def find_missing(index):
+    return index.query(
+        "SELECT d.file_id, d.filename, d.status, d.library_name, d.doc_link FROM documents d "
+        "WHERE d.library_name IS NOT NULL AND NOT EXISTS "
+        "(SELECT 1 FROM library_items i WHERE i.library_name = d.library_name AND i.file_ref = d.file_ref) "
+        "ORDER BY d.library_name, d.file_ref"
+    )
+
+
+# Uploaded rows whose file carries different metadata, one line per differing field.
+# Duplicates are left out: their file carries the metadata of the row that uploaded it.
+def find_mismatched(index):
+    for column, field in METADATA_FIELDS.items():
+        yield from index.query(
+            f"SELECT d.file_id, d.filename, d.library_name, i.item_id, d.file_ref, ?, d.[{column}], i.[{field}] "
+            f"FROM documents d JOIN library_items i ON i.library_name = d.library_name AND i.file_ref = d.file_ref "
+            f"WHERE d.status = ? AND d.[{column}] != i.[{field}] ORDER BY d.library_name, d.file_ref",
+            (field, SUCCESS_STATUS)
+        )
+
+
+# Items with the same RSAPin, DocumentType and size as another in the library, such as
+# a document uploaded twice by runs that crashed before writing its status
+def find_duplicated(index):
+    return index.query(
+        "SELECT i.library_name, i.[RSAPin], i.[DocumentType], i.file_size, i.item_id, i.file_ref, "
+        "EXISTS (SELECT 1 FROM documents d WHERE d.file_ref = i.file_ref) AS referenced "
+        "FROM library_items i JOIN ("
+        "  SELECT library_name, [RSAPin], [DocumentType], file_size FROM library_items "
+        "  WHERE file_size IS NOT NULL GROUP BY library_name, [RSAPin], [DocumentType], file_size "
+        "  HAVING COUNT(*) > 1"
+        ") g ON g.library_name = i.library_name AND g.[RSAPin] = i.[RSAPin] "
+        "AND g.[DocumentType] = i.[DocumentType] AND g.file_size = i.file_size "
+        "ORDER BY i.library_name, i.[RSAPin], i.[DocumentType], i.file_size, i.item_id"
+    )
+
+
+# Items no row links to
+def find_unreferenced(index):
+    return index.query(
+        "SELECT i.library_name, i.item_id, i.file_ref, i.[RSAPin], i.[DocumentType], i.file_size "
+        "FROM library_items i WHERE NOT EXISTS (SELECT 1 FROM documents d WHERE d.file_ref = i.file_ref) "
+        "ORDER BY i.library_name, i.item_id"
+    )
+
+
+# Write the reports to output_dir and return the number of lines in each
+def write_reports(index, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    reports = {
+        'missing': (['FILEID', 'FILENAME', 'status', 'library', 'doc_link'], find_missing),
+        'mismatched': (['FILEID', 'FILENAME', 'library', 'item_id', 'file_ref', 'field', 'database_value',
+                        'sharepoint_value'], find_mismatched),
+        'duplicated': (['library', 'RSAPin', 'DocumentType', 'file_size', 'item_id', 'file_ref', 'referenced'],
+                       find_duplicated),
+        'unreferenced': (['library', 'item_id', 'file_ref', 'RSAPin', 'DocumentType', 'file_size'],
+                         find_unreferenced)
+    }
+    return {
+        name: write_report(os.path.join(output_dir, f"{name}.csv"), header, find(index))
+        for name, (header, find) in reports.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare SharePoint libraries with the document links in DB_TABLE_1')
+    parser.add_argument('--library', action='append', dest='libraries',
+                        help='library to reconcile; repeat for several (default: every routed library)')
+    parser.add_argument('--index', help='index file (default: RECONCILE_INDEX_PATH)')
+    parser.add_argument('--output', help='report directory (default: RECONCILE_OUTPUT_DIR)')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='pages fetched at once (default: the library max_concurrency or UPLOAD_WORKERS)')
+    parser.add_argument('--skip-fetch', action='store_true',
+                        help='reuse the library items already in the index instead of paging through the libraries')
+    args = parser.parse_args()
+    settings = get_settings()
+    args.index = args.index or settings.reconcile_index_path
+    args.output = args.output or settings.reconcile_output_dir
+
+    library_names = args.libraries or get_routing_table().libraries()
+    index = ReconcileIndex(args.index)
+    try:
+        for library_name in library_names:
+            print(f"{library_name}: list item type {get_list_item_type(library_name)}")
+            if not args.skip_fetch:
+                count = index_library(index, library_name, args.page_size, args.workers)
+                print(f"{library_name}: indexed {count} items")
+        print(f"Indexed {index_documents(index, library_names)} rows with a doc_link from DB_TABLE_1")
+        for name, count in write_reports(index, args.output).items():
+            print(f"{name}: {count} (see {os.path.join(args.output, name + '.csv')})")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Optional
+from settings import get_settings
+from upload_engine import get_upload_workers
+import json
+
+# APPLICATION_TYPE values of the two document types the API has always accepted
+APPLICATION_TYPES = {
+    'dmu': 'DMU',
+    'benefit': 'CASE OR BA DOCUMENT'
+}
+
+
+# Documents with this APPLICATION_TYPE (and DOCTYPE_NAME, when set) go to library,
+# optionally into a folder inside it
+@dataclass(frozen=True)
+class Route:
+    application_type: str
+    library: str
+    doc_type: Optional[str] = None
+    folder: Optional[str] = None
+
+
+# Routes plus per-library settings. Every library gets its own claim stream and
+# worker pool, so a slow library does not hold up the others.
+@dataclass(frozen=True)
+class RoutingTable:
+    routes: tuple
+    max_concurrency: dict = field(default_factory=dict)
+
+    def _routes_for(self, application_types=None):
+        return [route for route in self.routes
+                if application_types is None or route.application_type in application_types]
+
+    # Libraries with at least one route, in the order they first appear
+    def libraries(self, application_types=None):
+        return list(dict.fromkeys(route.library for route in self._routes_for(application_types)))
+
+    # The route for a document: a DOCTYPE_NAME match wins over the APPLICATION_TYPE default
+    def resolve(self, application_type, doc_type):
+        default = None
+        for route in self.routes:
+            if route.application_type != application_type:
+                continue
+            if route.doc_type is not None and route.doc_type == doc_type:
+                return route
+            if route.doc_type is None and default is None:
+                default = route
+        return default
+
+    # (application_type, doc_type, excluded_doc_types) selectors for the rows routed to
+    # library, as taken by database.claim_documents. A route without a doc_type
+    # excludes the DOCTYPE_NAMEs that more specific routes send elsewhere.
+    def selectors(self, library, application_types=None):
+        selectors = []
+        for route in self._routes_for(application_types):
+            if route.library != library or self.resolve(route.application_type, route.doc_type) != route:
+                continue
+            excluded = ()
+            if route.doc_type is None:
+                excluded = tuple(other.doc_type for other in self.routes
+                                 if other.application_type == route.application_type
+                                 and other.doc_type is not None and other.library != library)
+            selectors.append((route.application_type, route.doc_type, excluded))
+        return selectors
+
+    def get_max_concurrency(self, library):
+        return self.max_concurrency.get(library)
+
+    # Uploads in flight when every library's worker pool is busy at once
+    def get_total_concurrency(self):
+        return sum(self.get_max_concurrency(library) or get_upload_workers() for library in self.libraries())
+
+
+# Routing table from the JSON file at ROUTING_TABLE_PATH, e.g.
+#
+#   {
+#     "libraries": {"DMU Library": {"max_concurrency": 4}},
+#     "routes": [
+#       {"application_type": "DMU", "library": "DMU Library"},
+#       {"application_type": "CASE OR BA DOCUMENT", "doc_type": "Birth Certificate",
+#        "library": "Benefit Library", "folder": "Certificates"},
+#       {"application_type": "CASE OR BA DOCUMENT", "library": "Benefit Library"}
+#     ]
+#   }
+#
+# Without a file, DMU documents go to SHAREPOINT_LIBRARY_NAME_DMU and case or BA
+# documents to SHAREPOINT_LIBRARY_NAME_BENEFIT, as before.
+def load_routing_table():
+    settings = get_settings()
+    path = settings.routing_table_path
+    if not path:
+        routes = [
+            Route(APPLICATION_TYPES['dmu'], settings.library_name_dmu),
+            Route(APPLICATION_TYPES['benefit'], settings.library_name_benefit)
+        ]
+        return RoutingTable(tuple(route for route in routes if route.library))
+
+    with open(path) as file:
+        config = json.load(file)
+
+    routes = []
+    for entry in config.get('routes', []):
+        if not entry.get('application_type') or not entry.get('library'):
+            raise Exception(f"Routing table {path}: every route needs an application_type and a library: {entry}")
+        routes.append(Route(entry['application_type'], entry['library'], entry.get('doc_type'), entry.get('folder')))
+    if not routes:
+        raise Exception(f"Routing table {path} has no routes")
+
+    max_concurrency = {
+        library: int(options['max_concurrency'])
+        for library, options in config.get('libraries', {}).items()
+        if options.get('max_concurrency')
+    }
+    return RoutingTable(tuple(routes), max_concurrency)
+
+
+@lru_cache(maxsize=None)
+def get_routing_table():
+    return load_routing_table()
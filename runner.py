@@ -0,0 +1,216 @@
+from database import (iter_document_metadata, get_documents_with_file_path, count_pending_documents,
+                      flush_document_statuses, renew_claims, release_claims, get_claim_lease_seconds, get_engine)
+from upload_engine import run_bounded, prefetch
+from file_reader import prescan_documents
+from sharepoint import get_list_item_type, get_concurrency_controller, get_request_digest, check_folder_exists
+from routing import APPLICATION_TYPES, get_routing_table
+from validation import warm_up_validation
+from uploader import upload_access_document, upload_path_document, resume_journaled_uploads
+from jobs import MigrationJob, SUCCESS_STATUS
+from metrics import UPLOADS_IN_FLIGHT, document_span, record_document
+from settings import get_settings
+import argparse
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_TYPES = list(APPLICATION_TYPES)
+
+
+# APPLICATION_TYPEs a job for document_type covers; None (every routed type) when unset
+def get_application_types(document_type=None):
+    if document_type is None:
+        return None
+    return [APPLICATION_TYPES[document_type]]
+
+
+# Identifies this process's claims in DB_TABLE_1; WORKER_ID overrides the host:pid default.
+# Without a job, the id of the start-up recovery pass.
+def get_worker_id(job=None):
+    base = get_settings().worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    return f"{base}:{job.id[:8] if job else 'recovery'}"
+
+
+# Keeps the leases on a worker's claimed rows alive while it runs, then writes any
+# buffered statuses and hands back rows it never got to
+class ClaimLease:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._renew, name='claim-lease', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stopped.set()
+        self._thread.join()
+        try:
+            flush_document_statuses()
+        finally:
+            release_claims(self.worker_id)
+
+    def _renew(self):
+        interval = get_claim_lease_seconds() / 3
+        while not self._stopped.wait(interval):
+            try:
+                renew_claims(self.worker_id)
+            except Exception:
+                logger.exception("Failed to renew claims for %s", self.worker_id)
+
+
+# Stream claimed rows through the library's worker pool, into the folder their route
+# names, updating the job's counters as each document finishes and honouring its
+# pause/cancel controls. The pool is capped at the library's max_concurrency.
+def run_job_batch(job, rows, upload_document, library_name):
+    routing_table = get_routing_table()
+    # Fetch the correct List Item Entity Type for the library
+    list_item_type = get_list_item_type(library_name)
+
+    def upload(row):
+        route = routing_table.resolve(row.get('application_type'), row.get('doc_type'))
+        with UPLOADS_IN_FLIGHT.track(), document_span(row):
+            return upload_document(row, library_name, list_item_type, route.folder if route else None)
+
+    def record(row, status):
+        job.record(status, row.get('file_size'))
+        record_document(status, row.get('file_size'), uploaded=status == SUCCESS_STATUS)
+
+    run_bounded(rows, upload, max_workers=routing_table.get_max_concurrency(library_name), control=job,
+                on_result=record, limiter=get_concurrency_controller())
+
+
+# Run every routed library of the job side by side, each with its own claim stream and
+# worker pool, so a slow or throttled library does not hold up the others.
+# claim_rows(selectors, worker_id) returns the rows to upload for one library.
+def run_routed_migration(job, document_type, drain, claim_rows, upload_document):
+    routing_table = get_routing_table()
+    application_types = get_application_types(document_type)
+    libraries = {library: routing_table.selectors(library, application_types)
+                 for library in routing_table.libraries(application_types)}
+    if not libraries:
+        raise Exception(f"No routes for document type {document_type}")
+
+    worker_id = get_worker_id(job)
+    job.total = sum(count_pending_documents(selectors, drain) for selectors in libraries.values())
+    errors = {}
+
+    def run_library(library_name, selectors):
+        try:
+            run_job_batch(job, claim_rows(selectors, worker_id), upload_document, library_name)
+        except Exception as e:
+            logger.exception("Migration to %s failed", library_name)
+            errors[library_name] = e
+
+    with ClaimLease(worker_id):
+        threads = [threading.Thread(target=run_library, args=(library_name, selectors),
+                                    name=f"library-{library_name}")
+                   for library_name, selectors in libraries.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise Exception("; ".join(f"{library_name}: {e}" for library_name, e in errors.items()))
+
+
+# Upload one FILE_BATCH_NO batch of blob documents per library, or every pending one when draining
+def run_access_migration(job, document_type=None, drain=False):
+    run_routed_migration(
+        job, document_type, drain,
+        lambda selectors, worker_id: iter_document_metadata(selectors, worker_id, drain=drain),
+        upload_access_document
+    )
+
+
+# Upload one FILE_BATCH_NO batch of file share documents per library, or every pending one when draining
+def run_path_migration(job, document_type=None, drain=False):
+    run_routed_migration(
+        job, document_type, drain,
+        # Pre-scan the file share on a background thread ahead of the upload workers
+        lambda selectors, worker_id: prefetch(prescan_documents(
+            get_documents_with_file_path(selectors, worker_id, drain=drain))),
+        upload_path_document
+    )
+
+
+# Finish the uploads that processes which exited mid-run left in their journals, so
+# they are not uploaded again under a new name. Failures are logged rather than
+# raised; their journals are replayed again at the next start.
+def recover_uploads():
+    try:
+        resumed = resume_journaled_uploads(get_worker_id())
+    except Exception:
+        logger.warning("Recovery of journaled uploads failed", exc_info=True)
+        return
+    if resumed:
+        logger.info("Finished %d journaled uploads left by an earlier run", resumed)
+
+
+# Pay the first-request costs up front: the form digest, list item types and folder
+# checks for each routed library, a database connection, and the validation processes.
+# Failures are logged rather than raised, so the API still starts when SharePoint
+# or the database is unreachable; the first migration then retries them.
+def warm_up():
+    steps = [('form digest', get_request_digest)]
+    routing_table = get_routing_table()
+    for library_name in routing_table.libraries():
+        steps.append((f"list item type of {library_name}", lambda name=library_name: get_list_item_type(name)))
+        steps.append((f"folder of {library_name}", lambda name=library_name: check_folder_exists(name)))
+    for route in routing_table.routes:
+        if route.folder:
+            steps.append((f"folder {route.folder} of {route.library}",
+                          lambda route=route: check_folder_exists(route.library, route.folder)))
+    steps.append(('database connection', lambda: get_engine().connect().close()))
+    steps.append(('validation processes', warm_up_validation))
+
+    for name, step in steps:
+        try:
+            step()
+        except Exception:
+            logger.warning("Warm-up of the %s failed", name, exc_info=True)
+
+
+MIGRATIONS = {
+    'documents': run_access_migration,
+    'documents-from-path': run_path_migration
+}
+
+
+# Standalone worker: keeps claiming and uploading batches until the table is drained,
+# for every routed library or only those of --document-type. Start one per process
+# or host; claims keep them from uploading the same rows.
+#
+#   python runner.py --source documents
+#   python runner.py --document-type dmu --source documents
+def main():
+    parser = argparse.ArgumentParser(description='Drain pending documents from DB_TABLE_1 into SharePoint')
+    parser.add_argument('--document-type', choices=DOCUMENT_TYPES, default=None,
+                        help='only migrate this document type (default: every routed type)')
+    parser.add_argument('--source', choices=sorted(MIGRATIONS), default='documents')
+    parser.add_argument('--progress-seconds', type=float, default=30)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    recover_uploads()
+    job = MigrationJob(args.source, args.document_type or 'all')
+    thread = threading.Thread(target=job.run, args=(MIGRATIONS[args.source], args.document_type, True))
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(args.progress_seconds)
+            logger.info("%s", job.snapshot())
+    except KeyboardInterrupt:
+        logger.info("Cancelling; waiting for in-flight uploads to finish")
+        job.cancel()
+        thread.join()
+    logger.info("%s", job.snapshot())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import urljoin
+from dotenv import load_dotenv
+import os
+
+REQUIRED_VARIABLES = ['SHAREPOINT_SITE_URL', 'SHAREPOINT_SITE_PATH', 'SHAREPOINT_USERNAME', 'SHAREPOINT_PASSWORD']
+
+
+# Configuration of the API, the workers and the tools, read from the environment on
+# first use rather than at import, so modules can be imported (by tools, tests or
+# uvicorn workers) without it
+@dataclass(frozen=True)
+class Settings:
+    base_site_url: str  # e.g. "http://portal/sites/"
+    site_path: str  # e.g. "DocuCenter2"
+    username: str
+    password: str
+    library_name_dmu: Optional[str]
+    library_name_benefit: Optional[str]
+    routing_table_path: Optional[str]
+    pool_size: Optional[int]
+    upload_mode: str
+    chunked_upload_threshold: int
+    upload_chunk_size: int
+    digest_refresh_margin: int
+    metadata_batch_size: int
+    metadata_batch_wait_seconds: float
+    metadata_batch_max_pending: int
+    warmup_on_startup: bool
+    request_timeout: tuple
+    max_retries: int
+    backoff_base_seconds: float
+    backoff_max_seconds: float
+    max_retry_after_seconds: float
+    throttle_cooldown_seconds: float
+    upload_workers: int
+    upload_max_attempts: int
+    validation_workers: int
+    job_history_limit: int
+    worker_id: Optional[str]
+    db_username: Optional[str]
+    db_password: Optional[str]
+    db_server: Optional[str]
+    db_database: Optional[str]
+    db_driver: Optional[str]
+    db_table: Optional[str]
+    db_pool_size: Optional[int]
+    db_max_overflow: int
+    db_pool_recycle_seconds: int
+    db_status_batch_size: int
+    db_status_flush_seconds: float
+    db_claim_lease_seconds: int
+    db_fetch_chunk_size: int
+    file_batch_no: Optional[int]
+    journal_enabled: bool
+    journal_dir: str
+    journal_compact_bytes: int
+    dedup_enabled: bool
+    dedup_update_metadata: bool
+    dedup_index_path: str
+    tracing_enabled: bool
+    reconcile_index_path: str
+    reconcile_output_dir: str
+
+    # Full site URL for API requests
+    @property
+    def site_url(self):
+        return urljoin(self.base_site_url, f"{self.site_path}/")
+
+
+def get_flag(name, default):
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes')
+
+
+def get_optional_int(name):
+    return int(os.getenv(name)) if os.getenv(name) else None
+
+
+def load_settings():
+    # Load environment variables from .env file
+    load_dotenv()
+
+    missing = [name for name in REQUIRED_VARIABLES if not os.getenv(name)]
+    if missing:
+        raise Exception(f"Missing required environment variables: {', '.join(missing)}")
+
+    # Ensure the base site URL is correct
+    base_site_url = os.getenv('SHAREPOINT_SITE_URL')
+    if not base_site_url.endswith('/'):
+        base_site_url += '/'
+
+    return Settings(
+        base_site_url=base_site_url,
+        site_path=os.getenv('SHAREPOINT_SITE_PATH'),
+        username=os.getenv('SHAREPOINT_USERNAME'),
+        password=os.getenv('SHAREPOINT_PASSWORD'),
+        library_name_dmu=os.getenv('SHAREPOINT_LIBRARY_NAME_DMU'),
+        library_name_benefit=os.getenv('SHAREPOINT_LIBRARY_NAME_BENEFIT'),
+        # JSON routing table replacing the two library names; see routing.load_routing_table
+        routing_table_path=os.getenv('ROUTING_TABLE_PATH'),
+        # Unset sizes the pool from the routed libraries' worker pools; see sharepoint.get_pool_size
+        pool_size=get_optional_int('SHAREPOINT_POOL_SIZE'),
+        # Write path used by push_to_sharepoint: classic, expand, validate or batch
+        upload_mode=os.getenv('SHAREPOINT_UPLOAD_MODE', 'expand'),
+        # Files larger than the threshold go through StartUpload/ContinueUpload/FinishUpload
+        chunked_upload_threshold=int(os.getenv('SHAREPOINT_CHUNKED_UPLOAD_THRESHOLD', 10 * 1024 * 1024)),
+        upload_chunk_size=int(os.getenv('SHAREPOINT_UPLOAD_CHUNK_SIZE', 10 * 1024 * 1024)),
+        # Refresh the form digest this many seconds before SharePoint expires it
+        digest_refresh_margin=int(os.getenv('SHAREPOINT_DIGEST_REFRESH_SECONDS', 60)),
+        # In batch mode, MERGEs per $batch request, and the longest an upload waits for others to join
+        metadata_batch_size=int(os.getenv('SHAREPOINT_METADATA_BATCH_SIZE', 50)),
+        metadata_batch_wait_seconds=float(os.getenv('SHAREPOINT_METADATA_BATCH_WAIT_SECONDS', 0.2)),
+        # MERGEs queued or being sent before uploads wait for the $batch sender; 0 is twice the batch size
+        metadata_batch_max_pending=int(os.getenv('SHAREPOINT_METADATA_BATCH_MAX_PENDING', 0)),
+        warmup_on_startup=get_flag('WARMUP_ON_STARTUP', 'true'),
+        # (connect, read) seconds before a SharePoint request counts as a dropped connection and is retried
+        request_timeout=(float(os.getenv('SHAREPOINT_CONNECT_TIMEOUT_SECONDS', 10)),
+                         float(os.getenv('SHAREPOINT_READ_TIMEOUT_SECONDS', 120))),
+        # Retries of throttled or transient SharePoint failures, with exponential backoff
+        max_retries=int(os.getenv('SHAREPOINT_MAX_RETRIES', 5)),
+        backoff_base_seconds=float(os.getenv('SHAREPOINT_BACKOFF_BASE_SECONDS', 1)),
+        backoff_max_seconds=float(os.getenv('SHAREPOINT_BACKOFF_MAX_SECONDS', 60)),
+        max_retry_after_seconds=float(os.getenv('SHAREPOINT_MAX_RETRY_AFTER_SECONDS', 300)),
+        # At most one decrease of the adaptive concurrency limit per cooldown
+        throttle_cooldown_seconds=float(os.getenv('SHAREPOINT_THROTTLE_COOLDOWN_SECONDS', 5)),
+        # Documents in flight at the same time, per library
+        upload_workers=max(1, int(os.getenv('UPLOAD_WORKERS', 8))),
+        # Deferrals after which a document gets a permanent failure status
+        upload_max_attempts=max(1, int(os.getenv('UPLOAD_MAX_ATTEMPTS', 5))),
+        # Processes for image integrity checks; all cores but one, which is left to the upload threads
+        validation_workers=max(1, int(os.getenv('VALIDATION_WORKERS', (os.cpu_count() or 2) - 1))),
+        # Finished jobs kept in memory for polling
+        job_history_limit=int(os.getenv('JOB_HISTORY_LIMIT', 100)),
+        # Claims rows as WORKER_ID, or as the host name and pid; see runner.get_worker_id
+        worker_id=os.getenv('WORKER_ID'),
+        db_username=os.getenv('DB_USERNAME'),
+        db_password=os.getenv('DB_PASSWORD'),
+        db_server=os.getenv('DB_SERVER'),
+        db_database=os.getenv('DB_DATABASE'),
+        db_driver=os.getenv('DB_DRIVER'),
+        db_table=os.getenv('DB_TABLE_1'),
+        # Unset sizes the pool from the routed libraries' worker pools; see database.get_db_pool_size
+        db_pool_size=get_optional_int('DB_POOL_SIZE'),
+        db_max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 5)),
+        db_pool_recycle_seconds=int(os.getenv('DB_POOL_RECYCLE_SECONDS', 1800)),
+        # Status updates are written every batch size rows or every flush interval
+        db_status_batch_size=int(os.getenv('DB_STATUS_BATCH_SIZE', 100)),
+        db_status_flush_seconds=float(os.getenv('DB_STATUS_FLUSH_SECONDS', 5)),
+        db_claim_lease_seconds=int(os.getenv('DB_CLAIM_LEASE_SECONDS', 900)),
+        db_fetch_chunk_size=int(os.getenv('DB_FETCH_CHUNK_SIZE', 500)),
+        # Rows migrated per run unless it drains the table
+        file_batch_no=get_optional_int('FILE_BATCH_NO'),
+        journal_enabled=get_flag('JOURNAL_ENABLED', 'true'),
+        journal_dir=os.getenv('JOURNAL_DIR', 'journal'),
+        # Rewrite the journal with only its open documents once it grows past this many bytes
+        journal_compact_bytes=int(os.getenv('JOURNAL_COMPACT_BYTES', 64 * 1024 * 1024)),
+        dedup_enabled=get_flag('DEDUP_ENABLED', 'true'),
+        # Whether a duplicate also gets its own metadata written to the existing file
+        dedup_update_metadata=get_flag('DEDUP_UPDATE_METADATA', 'false'),
+        dedup_index_path=os.getenv('DEDUP_INDEX_PATH', 'content_index.sqlite3'),
+        # Per-document spans; they also need the opentelemetry packages
+        tracing_enabled=get_flag('TRACING_ENABLED', 'false'),
+        reconcile_index_path=os.getenv('RECONCILE_INDEX_PATH', 'reconcile_index.sqlite3'),
+        reconcile_output_dir=os.getenv('RECONCILE_OUTPUT_DIR', 'reconciliation')
+    )
+
+
+# Settings for this process, loaded once. Raises when a required variable is unset.
+@lru_cache(maxsize=None)
+def get_settings():
+    return load_settings()
@@ -0,0 +1,732 @@
+from requests_ntlm import HttpNtlmAuth
+from requests.adapters import HTTPAdapter
+from settings import get_settings
+from routing import get_routing_table
+from throttling import (ConcurrencyController, RetryableError, RETRYABLE_STATUS_CODES, THROTTLE_STATUS_CODES,
+                        backoff_delay, get_retry_after, send_with_retry)
+from metrics import Counter as MetricCounter, Gauge, time_stage
+from upload_engine import get_upload_workers, then
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import re
+import requests
+import threading
+import time
+import uuid
+from collections import Counter
+from urllib.parse import quote, urljoin
+
+# One keep-alive connection pool shared by every worker and an adaptive cap on
+# in-flight uploads; both are sized from the settings when first used
+_adapter = None
+_concurrency_controller = None
+_setup_lock = threading.Lock()
+
+# Sessions are per thread because the NTLM handshake state lives on the auth
+# object; they all borrow connections from the shared adapter
+_thread_local = threading.local()
+_metrics_lock = threading.Lock()
+_request_counts = Counter()
+
+SHAREPOINT_REQUESTS = MetricCounter('sharepoint_requests_total', 'SharePoint HTTP responses, by status code',
+                                    ['status_code'])
+
+
+# Keep-alive connections to the farm: SHAREPOINT_POOL_SIZE, or by default one for every
+# thread of every routed library's worker pool, so libraries never wait on each
+# other for a connection. Tools run without routes get UPLOAD_WORKERS.
+def get_pool_size():
+    return get_settings().pool_size or get_routing_table().get_total_concurrency() or get_upload_workers()
+
+
+def get_adapter():
+    global _adapter
+    with _setup_lock:
+        if _adapter is None:
+            _adapter = HTTPAdapter(pool_connections=1, pool_maxsize=get_pool_size(), pool_block=True)
+    return _adapter
+
+
+# Adaptive cap on in-flight uploads, fed by every SharePoint response. It is shared by
+# every library's worker pool, so it limits what the farm sees from the whole process.
+def get_concurrency_controller():
+    global _concurrency_controller
+    with _setup_lock:
+        if _concurrency_controller is None:
+            _concurrency_controller = ConcurrencyController(max_limit=get_pool_size())
+    return _concurrency_controller
+
+
+def _count_response(response, *args, **kwargs):
+    SHAREPOINT_REQUESTS.inc(status_code=response.status_code)
+    with _metrics_lock:
+        _request_counts['requests'] += 1
+        _request_counts[f"status_{response.status_code}"] += 1
+        # requests_ntlm re-sends the request after a 401 challenge
+        if response.history:
+            _request_counts['ntlm_handshakes'] += 1
+
+
+def get_session():
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        settings = get_settings()
+        adapter = get_adapter()
+        session = requests.Session()
+        session.auth = HttpNtlmAuth(settings.username, settings.password)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(_count_response)
+        _thread_local.session = session
+    return session
+
+
+def _connection_pools():
+    if _adapter is None:
+        return []
+    pools = [_adapter.poolmanager.pools.get(key) for key in list(_adapter.poolmanager.pools.keys())]
+    return [pool for pool in pools if pool is not None]
+
+
+# Pool gauges are only reported once the pool exists; rendering metrics never creates it
+SHAREPOINT_POOL_SIZE = Gauge('sharepoint_pool_max_connections', 'Keep-alive SharePoint connections allowed',
+                             function=lambda: get_pool_size() if _adapter is not None else None)
+SHAREPOINT_POOL_IDLE = Gauge('sharepoint_pool_idle_connections', 'Open SharePoint connections waiting for a request',
+                             function=lambda: sum(pool.pool.qsize() for pool in _connection_pools() if pool.pool)
+                             if _adapter is not None else None)
+SHAREPOINT_CONCURRENCY_LIMIT = Gauge('sharepoint_concurrency_limit', 'Current adaptive limit on in-flight uploads',
+                                     function=lambda: _concurrency_controller.limit
+                                     if _concurrency_controller is not None else None)
+
+
+# Send a request on this thread's session, retrying throttled and transient failures.
+# Raises RetryableError when they outlast retries, SHAREPOINT_MAX_RETRIES by default.
+# A request that hangs past the connect or read timeout is retried like a dropped connection.
+def send_request(method, url, retries=None, **kwargs):
+    session = get_session()
+    kwargs.setdefault('timeout', get_settings().request_timeout)
+    data = kwargs.get('data')
+    # Rewind file-like bodies such as memory-mapped files before re-sending
+    rewind = data.seek if hasattr(data, 'seek') else None
+    return send_with_retry(
+        lambda: session.request(method, url, **kwargs),
+        controller=get_concurrency_controller(),
+        rewind=(lambda: rewind(0)) if rewind else None,
+        retries=retries
+    )
+
+
+# Snapshot of the shared connection pool and request counters
+def get_pool_metrics():
+    pool_size = get_pool_size()
+    pools = []
+    for pool in _connection_pools():
+        pools.append({
+            "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+            "max_size": pool_size,
+            "idle_connections": pool.pool.qsize() if pool.pool else 0,
+            "connections_opened": pool.num_connections,
+            "requests_sent": pool.num_requests
+        })
+    with _metrics_lock:
+        counters = dict(_request_counts)
+    return {
+        "pool_size": pool_size,
+        "pools": pools,
+        "counters": counters,
+        "concurrency": get_concurrency_controller().snapshot()
+    }
+
+
+# Digests are cached per site; list item types and known folders per site and library
+_cache_lock = threading.Lock()
+_digest_fetch_lock = threading.Lock()
+_digest_cache = {}
+_list_item_type_cache = {}
+_folder_cache = set()
+
+
+def get_request_digest(force_refresh=False):
+    settings = get_settings()
+    with _cache_lock:
+        cached = _digest_cache.get(settings.site_url)
+    if cached and not force_refresh and time.monotonic() < cached[1]:
+        return cached[0]
+
+    # One thread fetches a digest while the others wait for it. The cache lock is not
+    # held meanwhile, so list item type and folder lookups carry on through its retries.
+    with _digest_fetch_lock:
+        with _cache_lock:
+            current = _digest_cache.get(settings.site_url)
+        if current is not None and current is not cached and time.monotonic() < current[1]:
+            # Fetched by another thread while this one waited
+            return current[0]
+
+        digest_url = urljoin(settings.site_url, '_api/contextinfo')
+        digest_headers = {
+            "accept": "application/json;odata=verbose",
+            "content-type": "application/json;odata=verbose"
+        }
+        with time_stage('digest'):
+            digest_response = send_request('POST', digest_url, headers=digest_headers)
+        if digest_response.status_code != 200:
+            raise Exception(f"Failed to fetch form digest: {digest_response.status_code}, {digest_response.text}")
+        context_info = digest_response.json()['d']['GetContextWebInformation']
+        digest_value = context_info['FormDigestValue']
+        timeout = int(context_info.get('FormDigestTimeoutSeconds', 1800))
+
+        # Refresh proactively, but never hold a digest for less than half its lifetime
+        expires_at = time.monotonic() + max(timeout - settings.digest_refresh_margin, timeout / 2)
+        with _cache_lock:
+            _digest_cache[settings.site_url] = (digest_value, expires_at)
+        return digest_value
+
+
+def invalidate_request_digest():
+    with _cache_lock:
+        _digest_cache.pop(get_settings().site_url, None)
+
+
+# Drop cached list metadata, e.g. after the library was renamed or removed
+def invalidate_library_cache(sharepoint_library_name):
+    settings = get_settings()
+    with _cache_lock:
+        _list_item_type_cache.pop((settings.site_url, sharepoint_library_name), None)
+        for cache_key in [key for key in _folder_cache if key[:2] == (settings.site_url, sharepoint_library_name)]:
+            _folder_cache.discard(cache_key)
+
+
+def is_digest_error(response):
+    # SharePoint answers a stale or invalid X-RequestDigest with 403 and error -2130575251
+    return response.status_code == 403 or (
+        response.status_code == 400 and '2130575251' in response.text
+    )
+
+
+# POST with the cached form digest, refreshing it once if SharePoint rejects it
+def post_with_digest(url, headers, **kwargs):
+    headers = dict(headers, **{"X-RequestDigest": get_request_digest()})
+    response = send_request('POST', url, headers=headers, **kwargs)
+    if is_digest_error(response):
+        invalidate_request_digest()
+        if hasattr(kwargs.get('data'), 'seek'):
+            kwargs['data'].seek(0)
+        headers["X-RequestDigest"] = get_request_digest(force_refresh=True)
+        response = send_request('POST', url, headers=headers, **kwargs)
+    return response
+
+
+def get_list_item_type(sharepoint_library_name):
+    settings = get_settings()
+    cache_key = (settings.site_url, sharepoint_library_name)
+    with _cache_lock:
+        if cache_key in _list_item_type_cache:
+            return _list_item_type_cache[cache_key]
+
+    list_url = urljoin(settings.site_url, f"_api/web/lists/GetByTitle('{sharepoint_library_name}')")
+    headers = {
+        "accept": "application/json;odata=verbose"
+    }
+    response = send_request('GET', list_url, headers=headers)
+    if response.status_code == 200:
+        list_data = response.json()
+        list_item_type = list_data['d']['ListItemEntityTypeFullName']
+        with _cache_lock:
+            _list_item_type_cache[cache_key] = list_item_type
+        return list_item_type
+    else:
+        raise Exception(f"Failed to fetch list item type: {response.status_code}, {response.text}")
+
+
+# Server-relative URL of a library, or of a folder inside it
+def get_folder_url(library_name, folder=None):
+    folder_url = f"/sites/{get_settings().site_path}/{quote(library_name)}"
+    if folder:
+        folder_url += f"/{quote(folder.strip('/'))}"
+    return folder_url
+
+
+# Check the library folder exists; only positive answers are cached
+def check_folder_exists(library_name, folder=None):
+    settings = get_settings()
+    cache_key = (settings.site_url, library_name, folder)
+    with _cache_lock:
+        if cache_key in _folder_cache:
+            return 200
+
+    folder_url = urljoin(settings.site_url, f"_api/web/GetFolderByServerRelativeUrl('{get_folder_url(library_name, folder)}')")
+    folder_response = send_request('GET', folder_url, headers={"accept": "application/json;odata=verbose"})
+    if folder_response.status_code == 200:
+        with _cache_lock:
+            _folder_cache.add(cache_key)
+    return folder_response.status_code
+
+
+# SharePoint field names for the document metadata columns
+def build_field_values(metadata):
+    return {
+        "RSAPin": metadata['pin'],
+        "FirstName": metadata['firstname'],
+        "Surname": metadata['lastname'],
+        "OtherNames": metadata['middlename'],
+        "MobileNo": metadata['phone'],
+        "EmployerName": metadata['employer_name'],
+        "EmployerCode": metadata['employer_code'],
+        "DocumentType": metadata['doc_type']
+    }
+
+
+# Item ID from an expanded Files/add response, or None when it was not expanded
+def get_expanded_item_id(upload_response):
+    try:
+        return upload_response.json()['d']['ListItemAllFields']['ID']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+# Read the item ID from an expanded Files/add response, or look it up with a GET.
+# Returns the item ID, or None and the failure status.
+def get_uploaded_item_id(upload_response, file_url):
+    item_id = get_expanded_item_id(upload_response)
+    if item_id is not None:
+        return item_id, None
+    return get_file_item_id(file_url)
+
+
+# Look up the list item ID of a file. Returns the item ID, or None and the failure status.
+def get_file_item_id(file_url):
+    settings = get_settings()
+    file_item_url = urljoin(settings.site_url, f"_api/web/GetFileByServerRelativeUrl('{file_url}')/ListItemAllFields")
+    with time_stage('item_lookup'):
+        file_item_response = send_request('GET', file_item_url, headers={"accept": "application/json;odata=verbose"})
+
+    if file_item_response.status_code != 200:
+        return None, f"Failed to get file item: {file_item_response.text}"
+
+    file_item_json = file_item_response.json()
+    return file_item_json['d']['ID'], None
+
+
+# Size and list item ID of a file, or (None, None) when it is not in the library
+def get_file_details(file_url):
+    settings = get_settings()
+    file_details_url = urljoin(settings.site_url, f"_api/web/GetFileByServerRelativeUrl('{file_url}')?$select=Length,ListItemAllFields/ID&$expand=ListItemAllFields")
+    with time_stage('item_lookup'):
+        response = send_request('GET', file_details_url, headers={"accept": "application/json;odata=verbose"})
+
+    if response.status_code == 404:
+        return None, None
+    if response.status_code != 200:
+        raise Exception(f"Failed to get file details: {response.status_code}, {response.text}")
+
+    file_json = response.json()['d']
+    return int(file_json['Length']), file_json['ListItemAllFields']['ID']
+
+
+# Set the metadata fields on a list item with a MERGE. Returns the failure status, if any.
+def merge_list_item(library_name, list_item_type, item_id, metadata):
+    settings = get_settings()
+    update_metadata_url = urljoin(settings.site_url, f"_api/web/lists/getbytitle('{quote(library_name)}')/items({item_id})")
+    update_data = {"__metadata": {"type": list_item_type}}  # Use the correct list item type
+    update_data.update(build_field_values(metadata))
+    update_headers = {
+        "accept": "application/json;odata=verbose",
+        "content-type": "application/json;odata=verbose",
+        "X-HTTP-Method": "MERGE",
+        "If-Match": "*"
+    }
+    with time_stage('metadata_update'):
+        update_response = post_with_digest(update_metadata_url, update_headers, json=update_data)
+    if update_response.status_code not in [200, 204]:  # 204 is No Content, which is also a success status
+        return f"Failed to update metadata: {update_response.text}"
+    return None
+
+
+# One MERGE of a $batch request, written as an HTTP request inside its own changeset
+# so a failed update does not stop the others
+def build_batch_merge_part(library_name, list_item_type, item_id, metadata):
+    settings = get_settings()
+    update_metadata_url = urljoin(settings.site_url, f"_api/web/lists/getbytitle('{quote(library_name)}')/items({item_id})")
+    update_data = {"__metadata": {"type": list_item_type}}  # Use the correct list item type
+    update_data.update(build_field_values(metadata))
+    changeset = f"changeset_{uuid.uuid4()}"
+    return (
+        f"Content-Type: multipart/mixed; boundary={changeset}\r\n\r\n"
+        f"--{changeset}\r\n"
+        f"Content-Type: application/http\r\n"
+        f"Content-Transfer-Encoding: binary\r\n\r\n"
+        f"PATCH {update_metadata_url} HTTP/1.1\r\n"
+        f"Content-Type: application/json;odata=verbose\r\n"
+        f"Accept: application/json;odata=verbose\r\n"
+        f"If-Match: *\r\n\r\n"
+        f"{json.dumps(update_data)}\r\n"
+        f"--{changeset}--\r\n"
+    )
+
+
+# (status code, body) of each request in a $batch response, in request order
+def parse_batch_response(response):
+    results = []
+    for match in re.finditer(r"HTTP/1\.1 (\d{3})[^\r\n]*\r\n(.*?)(?=\r\n--|\Z)", response.text, re.S):
+        body = match.group(2).split("\r\n\r\n", 1)
+        results.append((int(match.group(1)), body[1].strip() if len(body) > 1 else ''))
+    return results
+
+
+# Set once the farm refuses a $batch request, as SharePoint 2013 does. From then on,
+# batch mode sets each document's metadata inline, as expand mode does.
+_batch_unsupported = False
+_merge_executor = None
+
+
+def is_batch_supported():
+    return not _batch_unsupported
+
+
+# MERGEs that fall back from a $batch are sent concurrently on their own threads,
+# so the batcher's sender thread does not send them one at a time
+def send_merges(updates):
+    global _merge_executor
+    with _setup_lock:
+        if _merge_executor is None:
+            _merge_executor = ThreadPoolExecutor(max_workers=get_pool_size(), thread_name_prefix='metadata-merge')
+    return list(_merge_executor.map(lambda update: merge_list_item(*update), updates))
+
+
+# Send the MERGEs of (library_name, list_item_type, item_id, metadata) updates in one
+# $batch request. Returns the failure status, or None, of each update. Updates the
+# farm throttled or failed transiently inside the batch, and every update when it
+# does not support $batch, are sent as single MERGEs instead.
+def merge_list_items(updates):
+    global _batch_unsupported
+    if _batch_unsupported:
+        return send_merges(updates)
+
+    settings = get_settings()
+    batch = f"batch_{uuid.uuid4()}"
+    body = "".join(f"--{batch}\r\n{build_batch_merge_part(*update)}" for update in updates) + f"--{batch}--\r\n"
+    headers = {
+        "accept": "application/json;odata=verbose",
+        "content-type": f"multipart/mixed; boundary={batch}"
+    }
+    with time_stage('metadata_batch'):
+        batch_response = post_with_digest(urljoin(settings.site_url, "_api/$batch"), headers,
+                                          data=body.encode('utf-8'))
+
+    results = parse_batch_response(batch_response) if batch_response.status_code == 200 else []
+    if len(results) != len(updates):
+        if batch_response.status_code in [400, 404, 405, 501]:
+            _batch_unsupported = True
+        elif batch_response.status_code != 200:
+            raise Exception(f"Failed to update metadata in batch: {batch_response.status_code}, {batch_response.text}")
+        return send_merges(updates)
+
+    statuses = []
+    retries = []
+    for index, (update, (status_code, text)) in enumerate(zip(updates, results)):
+        if status_code in RETRYABLE_STATUS_CODES:
+            retries.append(index)
+            statuses.append(None)
+        elif status_code not in [200, 204]:
+            statuses.append(f"Failed to update metadata: {text}")
+        else:
+            statuses.append(None)
+    for index, status in zip(retries, send_merges([updates[index] for index in retries])):
+        statuses[index] = status
+    return statuses
+
+
+# Gathers the MERGEs of uploaded files into $batch requests, so upload workers move on
+# to the next document instead of waiting for a MERGE each. A sender thread sends a
+# batch once it holds batch_size updates, or wait_seconds after it started filling.
+# Once max_pending MERGEs are queued or being sent, add() waits for the sender, so a
+# slow $batch holds up the uploads rather than letting the backlog grow without bound.
+class MetadataBatcher:
+    def __init__(self, batch_size=None, wait_seconds=None, max_pending=None):
+        settings = get_settings()
+        self.batch_size = batch_size or settings.metadata_batch_size
+        self.wait_seconds = wait_seconds or settings.metadata_batch_wait_seconds
+        self.max_pending = max_pending or settings.metadata_batch_max_pending or 2 * self.batch_size
+        self._batch = []
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    # Queue a MERGE; returns a Future of its failure status, or None
+    def add(self, library_name, list_item_type, item_id, metadata):
+        future = Future()
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending < self.max_pending)
+            self._pending += 1
+            self._batch.append(((library_name, list_item_type, item_id, metadata), future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._send_batches, name='metadata-batcher', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        return future
+
+    def _send_batches(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._batch)
+                self._condition.wait_for(lambda: len(self._batch) >= self.batch_size, timeout=self.wait_seconds)
+                batch, self._batch = self._batch[:self.batch_size], self._batch[self.batch_size:]
+            try:
+                statuses = merge_list_items([update for update, future in batch])
+            except Exception as e:
+                statuses = None
+                error = e
+            with self._condition:
+                self._pending -= len(batch)
+                self._condition.notify_all()
+            for index, (update, future) in enumerate(batch):
+                if statuses is None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(statuses[index])
+
+
+_metadata_batcher = None
+
+
+def get_metadata_batcher():
+    global _metadata_batcher
+    with _setup_lock:
+        if _metadata_batcher is None:
+            _metadata_batcher = MetadataBatcher()
+    return _metadata_batcher
+
+
+# Set the metadata fields on a file that is already in the library, looking up its
+# item ID first when it is not known. Returns the item ID and the failure status, if any.
+def update_file_metadata(library_name, list_item_type, file_url, metadata, item_id=None):
+    if item_id is None:
+        item_id, status = get_file_item_id(file_url)
+        if item_id is None:
+            return None, status
+    return item_id, merge_list_item(library_name, list_item_type, item_id, metadata)
+
+
+# Server-relative URL of a file uploaded to the library (or a folder in it) as filename
+def get_file_url(library_name, filename, folder=None):
+    return f"{get_folder_url(library_name, folder)}/{quote(filename)}"
+
+
+# Set the metadata fields through ValidateUpdateListItem on the file's item, which
+# needs neither the item ID nor the list entity type.
+# Returns the response so the caller can fall back when the farm does not support it.
+def validate_update_list_item(file_url, metadata):
+    settings = get_settings()
+    validate_url = urljoin(settings.site_url, f"_api/web/GetFileByServerRelativeUrl('{file_url}')/ListItemAllFields/ValidateUpdateListItem")
+    form_values = [
+        {"FieldName": field, "FieldValue": "" if value is None else str(value)}
+        for field, value in build_field_values(metadata).items()
+    ]
+    headers = {
+        "accept": "application/json;odata=verbose",
+        "content-type": "application/json;odata=verbose"
+    }
+    with time_stage('metadata_update'):
+        return post_with_digest(validate_url, headers, json={"formValues": form_values, "bNewDocumentUpdate": True})
+
+
+def get_validate_errors(validate_response):
+    results = validate_response.json()['d']['ValidateUpdateListItem']['results']
+    return [f"{field['FieldName']}: {field['ErrorMessage']}" for field in results if field.get('HasException')]
+
+
+# overwrite=false makes a Files/add to a name already taken fail. Names are unique per
+# document, so a taken name means this same Files/add was re-sent after SharePoint had
+# stored the file but its response was lost; the file is ours when its size matches.
+def is_added_before(add_response, file_url, file_size):
+    if add_response.status_code not in [400, 409]:
+        return False
+    return get_file_details(file_url)[0] == file_size
+
+
+def use_chunked_upload(file_size):
+    settings = get_settings()
+    return file_size is not None and file_size > max(settings.chunked_upload_threshold, settings.upload_chunk_size)
+
+
+# Upload a large file in chunks, reading each one through read_chunk(offset, size)
+# so the whole file is never held in memory. Each chunk is sent once per attempt rather
+# than through send_request's retries: after a throttled or failed chunk the same upload
+# session carries on from the offset SharePoint committed, and a chunk whose response
+# was lost is re-sent, or skipped when SharePoint turns out to have committed it.
+# The session is only cancelled once a chunk fails SHAREPOINT_MAX_RETRIES times in a row.
+# hasher, when given, is updated with each chunk SharePoint accepts.
+# Returns whether the file was uploaded, and the last response.
+def upload_file_in_chunks(library_name, filename, read_chunk, file_size, expand=False, folder=None, hasher=None):
+    settings = get_settings()
+    folder_url = get_folder_url(library_name, folder)
+    headers = {
+        "accept": "application/json;odata=verbose",
+        "content-type": "application/octet-stream"
+    }
+
+    # Create an empty file, then stream the content into it
+    file_url = get_file_url(library_name, filename, folder)
+    add_url = urljoin(settings.site_url, f"_api/web/GetFolderByServerRelativeUrl('{folder_url}')/Files/add(url='{quote(filename)}',overwrite=false)")
+    add_response = post_with_digest(add_url, headers, data=b'')
+    if add_response.status_code not in [200, 201] and not is_added_before(add_response, file_url, 0):
+        return False, add_response
+
+    file_api_url = urljoin(settings.site_url, f"_api/web/GetFileByServerRelativeUrl('{file_url}')")
+    upload_id = uuid.uuid4()
+    offset = 0
+    failures = 0
+    # Set while the last chunk's fate is unknown: its response was lost or a 5xx
+    uncertain = False
+
+    while True:
+        chunk = read_chunk(offset, settings.upload_chunk_size)
+        # The source shrank since file_size was taken; stop rather than send empty chunks
+        if len(chunk or b'') < min(settings.upload_chunk_size, file_size - offset):
+            cancel_chunked_upload(file_api_url, upload_id)
+            raise Exception(f"Short read at offset {offset} of {file_size} bytes for {filename}")
+        if offset == 0:
+            chunk_url = f"{file_api_url}/StartUpload(uploadId=guid'{upload_id}')"
+        elif offset + len(chunk) >= file_size:
+            chunk_url = f"{file_api_url}/FinishUpload(uploadId=guid'{upload_id}',fileOffset={offset})"
+            if expand:
+                chunk_url += "?$expand=ListItemAllFields"
+        else:
+            chunk_url = f"{file_api_url}/ContinueUpload(uploadId=guid'{upload_id}',fileOffset={offset})"
+
+        try:
+            chunk_response = post_with_digest(chunk_url, headers, data=chunk, retries=0)
+        except RetryableError as e:
+            failures += 1
+            if failures > settings.max_retries:
+                cancel_chunked_upload(file_api_url, upload_id)
+                raise
+            # A throttled chunk was refused; anything else may have been committed
+            throttled = e.response is not None and e.response.status_code in THROTTLE_STATUS_CODES
+            uncertain = uncertain or not throttled
+            delay = get_retry_after(e.response) if throttled else None
+            time.sleep(backoff_delay(failures - 1) if delay is None else delay)
+            continue
+
+        if chunk_response.status_code in [200, 201]:
+            if hasher is not None:
+                hasher.update(chunk)
+            if '/FinishUpload(' in chunk_url:
+                return True, chunk_response
+            result = chunk_response.json()['d']
+            offset = int(result.get('StartUpload') or result.get('ContinueUpload') or offset + len(chunk))
+        elif uncertain and '/FinishUpload(' in chunk_url:
+            # The session is gone once FinishUpload has gone through
+            if get_file_details(file_url)[0] != file_size:
+                return False, chunk_response
+            if hasher is not None:
+                hasher.update(chunk)
+            return True, chunk_response
+        elif uncertain and chunk_response.status_code == 400:
+            # SharePoint rejects the offset because it committed the chunk already
+            if hasher is not None:
+                hasher.update(chunk)
+            offset += len(chunk)
+        else:
+            cancel_chunked_upload(file_api_url, upload_id)
+            return False, chunk_response
+        failures = 0
+        uncertain = False
+
+
+# Best-effort cleanup of an abandoned upload session
+def cancel_chunked_upload(file_api_url, upload_id):
+    try:
+        post_with_digest(f"{file_api_url}/CancelUpload(uploadId=guid'{upload_id}')",
+                         {"accept": "application/json;odata=verbose"})
+    except RetryableError:
+        pass
+
+
+# Upload file content to the library and set its metadata fields.
+# Returns the SharePoint file link, or None and the failure status.
+#
+# SHAREPOINT_UPLOAD_MODE picks how many write-path calls each document costs:
+#   classic  - Files/add, ListItemAllFields GET, MERGE
+#   expand   - Files/add returning ListItemAllFields, MERGE
+#   validate - Files/add, ValidateUpdateListItem (falls back to expand if unsupported)
+#   batch    - Files/add returning ListItemAllFields, MERGE sent with other uploads' in one $batch,
+#              or inline as in expand once the farm has refused a $batch
+#
+# Pass read_chunk(offset, size) and file_size instead of file_content to let files
+# above SHAREPOINT_CHUNKED_UPLOAD_THRESHOLD stream up in chunks. folder, when given,
+# is a folder inside the library to upload into. on_uploaded(file_url, item_id), when
+# given, is called once the file is in SharePoint, before its metadata is set. hasher,
+# when given, is fed the chunks of a chunked upload as they are sent.
+# In batch mode the result is a Future of the link and status, settled once the
+# MERGE's $batch has been answered, unless the upload itself failed.
+def push_to_sharepoint(library_name, list_item_type, filename, file_content, metadata, mode=None,
+                       read_chunk=None, file_size=None, folder=None, on_uploaded=None, hasher=None):
+    settings = get_settings()
+    mode = (mode or settings.upload_mode).lower()
+    folder_url = get_folder_url(library_name, folder)
+
+    # Check if the folder exists in SharePoint
+    folder_status = check_folder_exists(library_name, folder)
+    if folder_status != 200:
+        return None, f"Folder not found: {folder_status}"
+
+    file_url = get_file_url(library_name, filename, folder)
+    if read_chunk is not None and use_chunked_upload(file_size):
+        with time_stage('upload'):
+            added, upload_response = upload_file_in_chunks(library_name, filename, read_chunk, file_size,
+                                                           expand=mode in ('expand', 'validate', 'batch'),
+                                                           folder=folder, hasher=hasher)
+    else:
+        if file_content is None:
+            file_content = read_chunk(0, file_size)
+
+        upload_url = urljoin(settings.site_url, f"_api/web/GetFolderByServerRelativeUrl('{folder_url}')/Files/add(url='{quote(filename)}',overwrite=false)")
+        if mode in ('expand', 'validate', 'batch'):
+            upload_url += "?$expand=ListItemAllFields"
+        headers = {
+            "accept": "application/json;odata=verbose",
+            "content-type": "application/octet-stream"
+        }
+
+        with time_stage('upload'):
+            upload_response = post_with_digest(upload_url, headers, data=file_content)
+        # A retried Files/add that found its own file goes on; the item ID is looked up below
+        added = upload_response.status_code in [200, 201] or is_added_before(upload_response, file_url,
+                                                                             len(file_content))
+
+    if upload_response.status_code == 404:
+        invalidate_library_cache(library_name)
+    if not added:
+        return None, f"Failed to upload: {upload_response.text}"
+
+    if on_uploaded is not None:
+        on_uploaded(file_url, get_expanded_item_id(upload_response))
+    metadata_set = False
+
+    if mode == 'validate':
+        validate_response = validate_update_list_item(file_url, metadata)
+        if validate_response.status_code == 200:
+            errors = get_validate_errors(validate_response)
+            if errors:
+                return None, f"Failed to update metadata: {'; '.join(errors)}"
+            metadata_set = True
+        elif validate_response.status_code not in [400, 404, 405, 501]:
+            return None, f"Failed to update metadata: {validate_response.text}"
+
+    if not metadata_set:
+        item_id, status = get_uploaded_item_id(upload_response, file_url)
+        if item_id is None:
+            return None, status
+        # Construct the SharePoint file link
+        sharepoint_file_link = urljoin(settings.site_url, file_url)
+        if mode == 'batch' and is_batch_supported():
+            return then(get_metadata_batcher().add(library_name, list_item_type, item_id, metadata),
+                        lambda status: (None, status) if status else (sharepoint_file_link, "Uploaded successfully"))
+        status = merge_list_item(library_name, list_item_type, item_id, metadata)
+        if status:
+            return None, status
+
+    # Construct the SharePoint file link
+    sharepoint_file_link = urljoin(settings.site_url, file_url)
+    return sharepoint_file_link, "Uploaded successfully"
@@ -0,0 +1,148 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from settings import get_settings
+import random
+import requests
+import threading
+import time
+
+# Responses worth another attempt; 429 and 503 are SharePoint pushing back
+RETRYABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+THROTTLE_STATUS_CODES = [429, 503]
+
+
+# A transient failure (throttling, 5xx, dropped connection) that outlived its retries.
+# The document should be tried again later rather than marked as failed. response is
+# the last response, or None when the connection failed.
+class RetryableError(Exception):
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+# Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), get_settings().max_retry_after_seconds)
+
+
+# Exponential backoff with full jitter
+def backoff_delay(attempt):
+    settings = get_settings()
+    return random.uniform(0, min(settings.backoff_max_seconds, settings.backoff_base_seconds * 2 ** attempt))
+
+
+# AIMD limit on in-flight uploads: halves when SharePoint throttles or drops
+# connections, and grows by about one slot per round of successful responses
+# while latency stays near the best recently seen.
+class ConcurrencyController:
+    def __init__(self, max_limit, min_limit=1, decrease_factor=0.5, cooldown_seconds=None, latency_tolerance=2.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds or get_settings().throttle_cooldown_seconds
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(max_limit)
+        self._latency = None
+        self._baseline = None
+        self._last_decrease = 0.0
+        self._throttled = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+
+    @property
+    def limit(self):
+        return max(self.min_limit, int(self._limit))
+
+    def on_response(self, status_code, latency):
+        with self._lock:
+            if status_code in THROTTLE_STATUS_CODES:
+                self._throttled += 1
+                self._decrease()
+                return
+
+            self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            # Let the baseline drift up slowly so a permanently slower farm is not punished forever
+            self._baseline = self._latency if self._baseline is None else min(self._latency, self._baseline * 1.001)
+            if self._latency <= self._baseline * self.latency_tolerance:
+                limit = self.limit
+                self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+                if self.limit > limit:
+                    self._slot_freed.notify_all()
+
+    def on_error(self):
+        with self._lock:
+            self._decrease()
+
+    def _decrease(self):
+        # One decrease per cooldown, so a burst of 429s from one round counts once
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown_seconds:
+            self._limit = max(float(self.min_limit), self._limit * self.decrease_factor)
+            self._last_decrease = now
+
+    # Take a slot for one upload, waiting while the whole process already has limit
+    # in flight. Every worker pool shares the controller, so the limit holds across them.
+    def acquire(self):
+        with self._slot_freed:
+            while self._in_flight >= self.limit:
+                self._slot_freed.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._slot_freed:
+            self._in_flight -= 1
+            self._slot_freed.notify()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "max_limit": self.max_limit,
+                "throttled_responses": self._throttled,
+                "latency_seconds": round(self._latency, 4) if self._latency is not None else None,
+                "baseline_latency_seconds": round(self._baseline, 4) if self._baseline is not None else None
+            }
+
+
+# Call send() until it returns a non-retryable response, honouring Retry-After and
+# otherwise backing off exponentially with jitter. rewind() is called before each
+# retry so file-like bodies are re-sent from the start.
+# Raises RetryableError once max_retries is exhausted.
+def send_with_retry(send, controller=None, rewind=None, retries=None):
+    retries = get_settings().max_retries if retries is None else retries
+    for attempt in range(retries + 1):
+        started = time.monotonic()
+        try:
+            response = send()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if controller is not None:
+                controller.on_error()
+            if attempt == retries:
+                raise RetryableError(f"{type(e).__name__}: {e}") from e
+            delay = backoff_delay(attempt)
+        else:
+            if controller is not None:
+                controller.on_response(response.status_code, time.monotonic() - started)
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+            if attempt == retries:
+                raise RetryableError(f"{response.status_code}: {response.text[:200]}", response)
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+
+        if rewind is not None:
+            rewind()
+        time.sleep(delay)
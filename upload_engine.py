@@ -0,0 +1,137 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from settings import get_settings
+import queue
+import threading
+
+
+# Number of documents allowed in flight at the same time
+def get_upload_workers():
+    return get_settings().upload_workers
+
+
+# Apply fn to result or, when result is a Future (a document whose last step finishes
+# later, such as a MERGE sent in a $batch), to its value once ready, returning a Future
+# of fn's result. The Future's exception is passed to on_error, when given, instead.
+def then(result, fn, on_error=None):
+    if not isinstance(result, Future):
+        return fn(result)
+    chained = Future()
+
+    def settle(future):
+        try:
+            error = future.exception()
+            if error is None:
+                chained.set_result(fn(future.result()))
+            elif on_error is not None:
+                chained.set_result(on_error(error))
+            else:
+                chained.set_exception(error)
+        except Exception as e:
+            chained.set_exception(e)
+
+    result.add_done_callback(settle)
+    return chained
+
+
+# Run worker(item) for every item with at most max_workers documents in flight.
+# Items are pulled from the iterable only when a slot frees up, so a generator
+# source is never read further ahead than the pool can actually process.
+#
+# control, when given, is asked control.checkpoint() before each new item is
+# taken; it may block (pause) or return False (cancel). on_result(item, result)
+# is called as each document finishes. limiter, when given, is shared by every
+# run_bounded call (see throttling.ConcurrencyController): each document takes one
+# of its slots, so the total in flight across them stays within its current limit,
+# and none of them can take more than max_workers. A worker may return a
+# Future of its result; the document then stops counting as in flight, and
+# on_result is called when the Future completes, before run_bounded returns.
+def run_bounded(items, worker, max_workers=None, control=None, on_result=None, limiter=None):
+    max_workers = max_workers or get_upload_workers()
+    results = []
+
+    def run(item):
+        try:
+            return worker(item)
+        finally:
+            limiter.release()
+
+    def finish(item, result):
+        results.append(result)
+        if on_result is not None:
+            on_result(item, result)
+
+    def collect(done):
+        for future in done:
+            item = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = f"Failed to upload: {str(e)}"
+            if isinstance(result, Future):
+                deferred.append(then(result, lambda value, item=item: finish(item, value),
+                                     lambda e, item=item: finish(item, f"Failed to upload: {str(e)}")))
+            else:
+                finish(item, result)
+
+    futures = {}
+    deferred = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload') as executor:
+        pending = set()
+        for item in items:
+            while len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            if control is not None and not control.checkpoint():
+                break
+            if limiter is None:
+                future = executor.submit(worker, item)
+            else:
+                limiter.acquire()
+                future = executor.submit(run, item)
+            futures[future] = item
+            pending.add(future)
+
+        done, _ = wait(pending)
+        collect(done)
+
+    wait(deferred)
+    return results
+
+
+# Run an iterable on a background thread, keeping up to depth items ready ahead of
+# the consumer, so slow source work (DB reads, file share stats) overlaps the uploads
+def prefetch(items, depth=None):
+    depth = depth or get_upload_workers() * 2
+    buffer = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    end = object()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    threading.Thread(target=produce, name='prefetch', daemon=True).start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
@@ -0,0 +1,382 @@
+from database import (fetch_document_blob, read_document_blob_chunk, queue_document_status,
+                      flush_document_statuses, reclaim_document, release_claims, record_upload_attempts)
+from file_reader import open_mapped_file
+from sharepoint import (push_to_sharepoint, use_chunked_upload, update_file_metadata, get_file_url, get_file_details,
+                        get_list_item_type)
+from content_index import (get_content_index, hash_content, is_dedup_enabled, start_content_hash,
+                           update_duplicate_metadata)
+from journal import get_upload_journal, read_journal, CLAIMED, METADATA_SET
+from settings import get_settings
+from throttling import RetryableError
+from upload_engine import then
+from jobs import DUPLICATE_STATUS, SUCCESS_STATUS
+from metrics import time_stage
+from validation import MIME_SNIFF_BYTES, start_validation, get_validation_status
+from concurrent.futures import Future
+from contextlib import ExitStack
+from urllib.parse import urljoin, urlsplit
+import logging
+import os
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Result of a document whose upload kept hitting throttling or transient errors
+DEFERRED_STATUS = "Deferred"
+
+
+# A throttling or transient failure after the file reached SharePoint, while its item
+# was looked up or its metadata set. The file must not be uploaded again.
+class MetadataPendingError(RetryableError):
+    def __init__(self, file_link, error):
+        super().__init__(str(error))
+        self.file_link = file_link
+
+
+def sanitize_doctype(doctype):
+    # Replace or remove special characters that might cause issues
+    return doctype.replace("/", "-").replace("\\", "-").replace(" ", "_")
+
+
+# Documents of one member and doctype are uploaded concurrently, often within the same
+# second, so the name also carries the FILEID and a random token (a FILEID can have
+# several FILENAMEs). Files/add does not overwrite, so a clash fails instead of
+# replacing another document's file.
+def generate_unique_filename(pin, doctype, file_id, original_filename):
+    sanitized_doctype = sanitize_doctype(doctype)
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    name, ext = os.path.splitext(original_filename)
+    unique_name = f"{pin}_{sanitized_doctype}_{timestamp}_{file_id}_{uuid.uuid4().hex[:8]}{ext}"
+    return unique_name
+
+
+# Call upload() unless content with the same SHA-256 is already in the library for the
+# same RSAPin. A duplicate is linked to the existing file instead, and only gets its
+# status written, plus its metadata on that file when DEDUP_UPDATE_METADATA is set.
+# Content hashed by hasher while upload() streams it up cannot be looked up first;
+# it is only added to the index once uploaded.
+# Returns the SharePoint file link and status, or a Future of them when upload() does.
+def upload_unless_duplicate(content_hash, library_name, list_item_type, filename, row, file_size, upload,
+                            folder=None, hasher=None):
+    pin = row['pin']
+    content_index = get_content_index()
+
+    def record(outcome):
+        sharepoint_file_link, status = outcome
+        if sharepoint_file_link is not None:
+            content_index.record(content_hash or hasher.hexdigest(), library_name, pin, sharepoint_file_link,
+                                 get_file_url(library_name, filename, folder), file_size=file_size)
+        return outcome
+
+    if content_hash is None:
+        return upload() if hasher is None else then(upload(), record)
+
+    with ExitStack() as stack:
+        stack.enter_context(content_index.hold(content_hash, library_name, pin))
+        entry = content_index.lookup(content_hash, library_name, pin)
+        if entry is not None:
+            if update_duplicate_metadata():
+                item_id, status = update_file_metadata(library_name, list_item_type, entry['file_url'], row,
+                                                       entry['item_id'])
+            else:
+                item_id = get_file_details(entry['file_url'])[1]
+                status = None
+            if item_id is not None:
+                if entry['item_id'] is None:
+                    content_index.set_item_id(content_hash, library_name, pin, item_id)
+                if status:
+                    return None, status
+                return entry['file_link'], DUPLICATE_STATUS
+            # The indexed file is no longer in the library; upload it again
+            content_index.forget(content_hash, library_name, pin)
+
+        outcome = then(upload(), record)
+        if isinstance(outcome, Future):
+            # Keep other documents with this content waiting until the upload is in the index
+            held = stack.pop_all()
+            outcome.add_done_callback(lambda future: held.close())
+        return outcome
+
+
+# push_to_sharepoint, journaling each step so that a crash part-way through is finished
+# by resume_journaled_uploads instead of uploading the document again.
+# original_filename is the FILENAME its status is written under.
+def push_with_journal(row, original_filename, content_hash, library_name, list_item_type, filename, file_content,
+                      read_chunk=None, file_size=None, folder=None, hasher=None):
+    file_id = row['fileid']
+    journal = get_upload_journal()
+    journal.claimed(row, file_id, original_filename, row.get('claimed_by'), library_name, folder,
+                    get_file_url(library_name, filename, folder), file_size, content_hash)
+    uploaded_to = []
+
+    def on_uploaded(file_url, item_id):
+        journal.uploaded(file_id, original_filename, file_url, item_id,
+                         hasher.hexdigest() if hasher is not None else None)
+        uploaded_to.append(file_url)
+
+    def metadata_set(outcome):
+        if outcome[0] is not None:
+            journal.metadata_set(file_id, original_filename, outcome[0])
+        return outcome
+
+    def failed(e):
+        if uploaded_to and isinstance(e, RetryableError):
+            raise MetadataPendingError(urljoin(get_settings().site_url, uploaded_to[0]), e) from e
+        raise e
+
+    try:
+        outcome = push_to_sharepoint(library_name, list_item_type, filename, file_content, row,
+                                     read_chunk=read_chunk, file_size=file_size, folder=folder,
+                                     on_uploaded=on_uploaded, hasher=hasher)
+    except Exception as e:
+        failed(e)
+    return then(outcome, metadata_set, failed)
+
+
+# Finish a row whose file an earlier attempt uploaded but could not set the metadata of
+# (see settle_upload): set it on that file, as resume_document does, instead of
+# uploading the document again. Returns the SharePoint file link and status, or None
+# when the file is no longer in the library and the document should be uploaded afresh.
+def finish_uploaded_document(row, library_name, list_item_type):
+    file_url = urlsplit(row['doc_link']).path
+    file_size, item_id = get_file_details(file_url)
+    if file_size is None:
+        return None
+    item_id, status = update_file_metadata(library_name, list_item_type, file_url, row, item_id)
+    return row['doc_link'], status or SUCCESS_STATUS
+
+
+# Run upload() and queue the document's SharePoint file link and status for the next
+# batched database write. Returns the status, or in batch mode a Future of it that
+# completes once the document's metadata batch has been answered. When upload()
+# returns None there is nothing to record, and neither is returned.
+def settle_upload(row, original_filename, upload):
+    file_id = row['fileid']
+
+    def finish(outcome):
+        if outcome is None:
+            return None
+        sharepoint_file_link, status = outcome
+        queue_document_status(file_id, sharepoint_file_link, status, original_filename)
+        return status
+
+    def fail(e):
+        # The file already in SharePoint, from this attempt or an earlier one, stays linked
+        sharepoint_file_link = e.file_link if isinstance(e, MetadataPendingError) else row.get('doc_link')
+        if not isinstance(e, RetryableError):
+            return finish((sharepoint_file_link, f"Failed to upload: {str(e)}"))
+        attempts = (row.get('attempts') or 0) + 1
+        # Past UPLOAD_MAX_ATTEMPTS the failure is permanent, so a document SharePoint
+        # always fails on does not come back forever
+        if attempts >= get_settings().upload_max_attempts:
+            return finish((sharepoint_file_link, f"Failed after {attempts} attempts: {str(e)}"))
+
+        # Leave the status empty; the row is handed back when the run ends and retried later
+        record_upload_attempts(file_id, original_filename, attempts)
+        if isinstance(e, MetadataPendingError):
+            # Record only the link: the journal entry stays open, and whichever worker
+            # claims the row next sets the metadata on this file rather than uploading it again
+            queue_document_status(file_id, sharepoint_file_link, None, original_filename)
+        else:
+            get_upload_journal().abandon(file_id, original_filename)
+        return f"{DEFERRED_STATUS}: {str(e)}"
+
+    try:
+        outcome = upload()
+    except Exception as e:
+        return fail(e)
+    return then(outcome, finish, fail)
+
+
+# Validate, upload and record the status of one record from iter_document_metadata,
+# into folder inside the library when the routing table names one
+def upload_access_document(row, library_name, list_item_type, folder=None):
+    file_id = row['fileid']
+    pin = row['pin']
+    doctype = row['doc_type']
+    original_filename = row['filename']
+
+    # The file reached SharePoint in an earlier attempt; only its metadata is missing
+    if row.get('doc_link'):
+        status = settle_upload(row, original_filename,
+                               lambda: finish_uploaded_document(row, library_name, list_item_type))
+        if status is not None:
+            return status
+
+    # The blob is only read once a worker picks the document up. Large blobs are
+    # streamed to SharePoint in chunks, so only their first bytes are read here
+    # for the MIME check.
+    def read_blob_chunk(offset, size):
+        return read_document_blob_chunk(file_id, original_filename, offset, size)
+
+    file_size = row.get('file_size')
+    read_chunk = read_blob_chunk if use_chunked_upload(file_size) else None
+    if read_chunk is not None:
+        file_item = read_chunk(0, MIME_SNIFF_BYTES)
+    else:
+        file_item = fetch_document_blob(file_id, original_filename)
+    if file_item is None:
+        status = "Invalid document file"
+        queue_document_status(file_id, None, status, original_filename)
+        return status
+
+    # Generate a unique filename
+    filename = generate_unique_filename(pin, doctype, file_id, original_filename)
+
+    # Sniff the MIME type here and verify images and PDFs in the validation process
+    # pool, which keeps decoding off the upload threads; chunked blobs are too large
+    # to verify in memory and only get the MIME check
+    with time_stage('validation'):
+        validation = start_validation(file_item, file_item=file_item if read_chunk is None else None)
+        status = get_validation_status(validation)
+    if status is not None:
+        queue_document_status(file_id, None, status, original_filename)
+        return status
+
+    # Hash the blob already in memory. A chunked blob is hashed as its chunks are read
+    # for the upload, which saves reading it an extra time.
+    content_hash = None
+    hasher = None
+    if is_dedup_enabled():
+        if read_chunk is None:
+            with time_stage('hash'):
+                content_hash = hash_content(file_item)
+        else:
+            hasher = start_content_hash()
+
+    # Upload the file to SharePoint
+    if read_chunk is not None:
+        file_item = None
+    return settle_upload(row, original_filename, lambda: upload_unless_duplicate(
+        content_hash, library_name, list_item_type, filename, row, file_size,
+        lambda: push_with_journal(row, original_filename, content_hash, library_name, list_item_type, filename,
+                                  file_item, read_chunk=read_chunk, file_size=file_size, folder=folder,
+                                  hasher=hasher),
+        folder, hasher
+    ))
+
+
+# Upload and record the status of one pre-scanned row from get_documents_with_file_path
+def upload_path_document(row, library_name, list_item_type, folder=None):
+    file_id = row['fileid']
+    pin = row['pin']
+    doctype = row['doc_type']
+    file_path = row['file_path']
+    original_filename = os.path.basename(file_path)
+
+    # The file reached SharePoint in an earlier attempt; only its metadata is missing
+    if row.get('doc_link'):
+        status = settle_upload(row, original_filename,
+                               lambda: finish_uploaded_document(row, library_name, list_item_type))
+        if status is not None:
+            return status
+
+    # Missing files, unsupported extensions and invalid content were caught by
+    # prescan_documents, whose content checks run ahead of the upload workers
+    status = row['prescan_status']
+    if not status:
+        with time_stage('validation'):
+            status = get_validation_status(row['validation'])
+    if status:
+        queue_document_status(file_id, None, status, original_filename)
+        return status
+
+    # Generate a unique filename
+    filename = generate_unique_filename(pin, doctype, file_id, original_filename)
+
+    # Upload the file to SharePoint straight from a memory map of the file. In batch
+    # mode only the MERGE is left once the upload returns, so the map can be closed.
+    # The size is taken from the map, as the file may have changed since the prescan.
+    def upload():
+        with open_mapped_file(file_path) as mapped:
+            file_size = len(mapped)
+
+            def read_chunk(offset, size):
+                return mapped[offset:offset + size]
+
+            # Hashing the map pulls the file into the page cache the upload then reads from
+            content_hash = None
+            if is_dedup_enabled():
+                with time_stage('hash'):
+                    content_hash = hash_content(mapped)
+            return upload_unless_duplicate(
+                content_hash, library_name, list_item_type, filename, row, file_size,
+                lambda: push_with_journal(row, original_filename, content_hash, library_name, list_item_type,
+                                          filename, mapped, read_chunk=read_chunk, file_size=file_size,
+                                          folder=folder),
+                folder
+            )
+
+    return settle_upload(row, original_filename, upload)
+
+
+# Finish one document from a crashed process's journal. Returns True when its status
+# was queued, False when it was left for a later run to upload.
+def resume_document(document, worker_id):
+    file_id = document['file_id']
+    original_filename = document['filename']
+    library_name = document['library_name']
+    file_url = document['file_url']
+
+    # Skip rows whose status was written after all, or that a live worker has taken over
+    if not reclaim_document(file_id, original_filename, worker_id, document.get('worker_id')):
+        return False
+
+    item_id = document.get('item_id')
+    if document['stage'] == CLAIMED:
+        # The crash came before the upload was known to have finished. A chunked upload
+        # cut short leaves a partial file, so only a complete one counts.
+        file_size, item_id = get_file_details(file_url)
+        if file_size is None or (document['file_size'] is not None and file_size != document['file_size']):
+            return False
+
+    sharepoint_file_link = document.get('file_link') or urljoin(get_settings().site_url, file_url)
+    if document['stage'] != METADATA_SET:
+        item_id, status = update_file_metadata(library_name, get_list_item_type(library_name), file_url,
+                                               document['metadata'], item_id)
+        if item_id is None:
+            return False
+        if status:
+            queue_document_status(file_id, None, status, original_filename)
+            return True
+
+    if document.get('content_hash'):
+        get_content_index().record(document['content_hash'], library_name, document['metadata']['pin'],
+                                   sharepoint_file_link, file_url, item_id=item_id, file_size=document['file_size'])
+    queue_document_status(file_id, sharepoint_file_link, SUCCESS_STATUS, original_filename)
+    return True
+
+
+# Replay the journals of processes that exited mid-run. Documents already in
+# SharePoint get their missing metadata and status without being uploaded again;
+# the rest are handed back for a later run. A journal is deleted once every document
+# in it has been dealt with, and replayed again at the next start otherwise.
+# Returns the number of documents finished.
+def resume_journaled_uploads(worker_id):
+    journal = get_upload_journal()
+    resumed = 0
+    for path, lock_file in journal.orphaned_journals():
+        documents = read_journal(path)
+        failed = False
+        try:
+            for document in documents.values():
+                try:
+                    if resume_document(document, worker_id):
+                        resumed += 1
+                except Exception:
+                    logger.exception("Failed to resume %s from %s", document['key'], path)
+                    failed = True
+            flush_document_statuses()
+        finally:
+            release_claims(worker_id)
+            # The process that wrote the journal is gone, so hand back its other rows
+            # now rather than when their leases expire
+            for previous_worker_id in {document.get('worker_id') for document in documents.values()} - {None}:
+                release_claims(previous_worker_id)
+
+        if failed:
+            lock_file.close()
+        else:
+            journal.remove_orphan(path, lock_file)
+    return resumed
@@ -0,0 +1,162 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from settings import get_settings
+import io
+import multiprocessing
+import os
+import threading
+
+# Bytes read from the start of a document to detect its MIME type
+MIME_SNIFF_BYTES = 8192
+
+# Bytes searched for the PDF header and %%EOF trailer
+PDF_HEADER_BYTES = 1024
+PDF_TRAILER_BYTES = 2048
+
+INVALID_FILE_STATUS = "Invalid document file"
+
+IMAGE_MIME_TYPES = ['image/jpeg', 'image/png', 'image/bmp', 'image/gif']
+PDF_MIME_TYPES = ['application/pdf']
+
+# Validate file types
+VALID_MIME_TYPES = IMAGE_MIME_TYPES + PDF_MIME_TYPES + [
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.ms-excel',  # For .xls files
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'  # For .xlsx files
+]
+
+# libmagic loads its database when a handle is created and a handle must not be
+# shared between threads, so each upload thread keeps its own
+_local = threading.local()
+
+
+def get_magic():
+    if not hasattr(_local, 'magic'):
+        # Imported on first use so importing this module stays cheap
+        import magic
+        _local.magic = magic.Magic(mime=True)
+    return _local.magic
+
+
+# MIME type from the first MIME_SNIFF_BYTES of a document
+def get_mime_type(file_item):
+    return get_magic().from_buffer(bytes(file_item[:MIME_SNIFF_BYTES]))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_validation_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork: the parent runs many threads and holds open connections
+            _pool = ProcessPoolExecutor(max_workers=get_settings().validation_workers,
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _reset_validation_pool(broken):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+
+def _load_decoders():
+    from PIL import Image
+    Image.init()
+
+
+# Start the validation processes, with Pillow loaded, and this thread's libmagic
+# handle, so the first documents do not pay for process start-up
+def warm_up_validation():
+    get_magic()
+    pool = get_validation_pool()
+    for future in [pool.submit(_load_decoders) for _ in range(get_settings().validation_workers)]:
+        future.result()
+
+
+def is_valid_image(file_item=None, file_path=None):
+    from PIL import Image
+    try:
+        image = Image.open(file_path if file_path is not None else io.BytesIO(file_item))
+        image.verify()
+        return True
+    except Exception:
+        # Truncated files, unknown formats and decompression bombs all fail here
+        return False
+
+
+def is_valid_pdf(file_item=None, file_path=None):
+    if file_path is not None:
+        with open(file_path, 'rb') as file:
+            head = file.read(PDF_HEADER_BYTES)
+            file.seek(max(os.fstat(file.fileno()).st_size - PDF_TRAILER_BYTES, 0))
+            tail = file.read()
+    else:
+        head, tail = file_item[:PDF_HEADER_BYTES], file_item[-PDF_TRAILER_BYTES:]
+    return b'%PDF-' in head and b'%%EOF' in tail
+
+
+# Runs in a validation process. Returns None for a sound image, otherwise the failure status.
+def check_image(file_item=None, file_path=None):
+    return None if is_valid_image(file_item, file_path) else INVALID_FILE_STATUS
+
+
+# Start validating a document. The MIME type is sniffed here from head, the first
+# bytes of the document; images are then decoded in the validation pool from
+# file_item (the whole document) or file_path. A PDF's header and trailer are only
+# a few slices of it, so they are checked here rather than shipping the document to
+# another process. Without file_item or file_path, only the MIME type is checked.
+# Returns a Future for None or the failure status.
+def start_validation(head, file_item=None, file_path=None):
+    mime_type = get_mime_type(head)
+    if mime_type not in VALID_MIME_TYPES:
+        status = f"Unsupported file type: {mime_type}"
+    elif file_item is None and file_path is None:
+        status = None
+    elif mime_type in PDF_MIME_TYPES:
+        status = None if is_valid_pdf(file_item, file_path) else INVALID_FILE_STATUS
+    elif mime_type in IMAGE_MIME_TYPES:
+        pool = get_validation_pool()
+        try:
+            future = pool.submit(check_image, file_item, file_path)
+        except BrokenProcessPool:
+            _reset_validation_pool(pool)
+            pool = get_validation_pool()
+            future = pool.submit(check_image, file_item, file_path)
+        future.pool = pool
+        return future
+    else:
+        status = None
+
+    future = Future()
+    future.set_result(status)
+    return future
+
+
+# Start validating a document on the file share; see start_validation
+def start_file_validation(file_path):
+    try:
+        with open(file_path, 'rb') as file:
+            head = file.read(MIME_SNIFF_BYTES)
+    except OSError:
+        future = Future()
+        future.set_result("File not found")
+        return future
+    return start_validation(head, file_path=file_path)
+
+
+# Wait for a validation started by start_validation and return its status
+def get_validation_status(future):
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        # A validation process died, most likely inside a decoder on a malformed file;
+        # replace the pool so the next documents are still checked
+        _reset_validation_pool(future.pool)
+        return f"{INVALID_FILE_STATUS}: validation process crashed"